@@ -16,4 +16,5 @@
 
 from .base import (ListTranslationIndexCmd, DeleteTranslationIndexCmd, ClearAllTranslationIndexCmd,
                    DiscardTranslationCmd, MergeTranslationCmd, UpdateTranslationStatsCmd, RenameLanguageCmd,
-                   ClearUntranslationIndexCmd, CopyLanguageCmd, ClearTranslationIndexCmd)
+                   ClearUntranslationIndexCmd, CopyLanguageCmd, ClearTranslationIndexCmd,
+                   MigrateTranslationIndexCmd)
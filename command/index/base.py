@@ -148,7 +148,9 @@ class ClearTranslationIndexCmd(BaseLangIndexConfirmationCmd):
 
 class UpdateTranslationStatsCmd(BaseIndexCmd):
     def __init__(self):
-        super().__init__('upstats', 'Update translation stats of the specified TranslationIndex.')
+        super().__init__('upstats', 'Recount translation stats of the specified TranslationIndex. '
+                                    'Stats are updated incrementally when translations change, '
+                                    'use this to repair them.')
         self._parser.add_argument("-l", "--lang", default=None, type=str, metavar='language',
                                   help="The language to update. Update all languages when not passing this arg.")
 
@@ -175,3 +177,15 @@ class MergeTranslationCmd(BaseLangIndexConfirmationCmd):
                 f'Are you sure to merge translations of language {self.args.lang} from {source.nickname}:{source.tag} '
                 f'into {target.nickname}:{target.tag}?'):
             target.merge_translations_from(source, self.args.lang, say_only=self.config.say_only)
+
+
+class MigrateTranslationIndexCmd(BaseIndexConfirmationCmd):
+    def __init__(self):
+        super().__init__('migrate', 'Convert the database of the TranslationIndex into the SQLite format.')
+
+    @db_context
+    def invoke(self):
+        index = self.get_translation_index()
+        if self.args.yes or yes(f'Are your sure to migrate {index.nickname}:{index.tag}? '
+                                f'The original file will be kept as a .bak file.'):
+            index.migrate_db()
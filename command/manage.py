@@ -137,6 +137,7 @@ register(ClearUntranslationIndexCmd())
 register(ClearTranslationIndexCmd())
 register(UpdateTranslationStatsCmd())
 register(MergeTranslationCmd(), short_name='m')
+register(MigrateTranslationIndexCmd())
 
 # Read/Write translations from/to files
 register(SaveHtmlCmd(), short_name='sh')
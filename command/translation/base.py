@@ -14,9 +14,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import time
+from typing import Set, List, Tuple
+
 from command import BaseLangIndexCmd
+from command.translation.resume import RunJournal
 from config import default_config
 from store import TranslationIndex
+from store.database.base import db_context
+from store.fuzzy import FuzzyIndex
 from util import line_to_args
 from util.renpy import is_translatable
 
@@ -46,11 +52,19 @@ class TranslateCmd(BaseLangIndexCmd):
                                   help="Accept blank translated lines from the translator when updating translations.")
         self._parser.add_argument('--limit', type=int, default=-1,
                                   help='The max number of lines to be translated. Negative values mean no limit.')
+        self._parser.add_argument('--fuzzy', action='store_true',
+                                  help='Translate lines by similar lines translated before (in all TranslationIndexes) '
+                                       'before using the translator, see translator.fuzzy_match in config.yaml.')
+        self._parser.add_argument('--resume', action='store_true',
+                                  help='Resume the last run which is stopped halfway, lines translated or discarded '
+                                       'in the last run are not translated again.')
         self._translator = None
 
-    def get_untranslated_lines(self):
+    def get_untranslated_lines(self, skipped_tids: Set[str] = None):
         index = self.get_translation_index()
         tids_and_texts = index.get_untranslated_lines(self.args.lang, say_only=self.config.say_only)
+        if skipped_tids:
+            tids_and_texts = [t for t in tids_and_texts if t[0] not in skipped_tids]
         if self.args.limit >= 0:
             tids_and_texts = tids_and_texts[:self.args.limit]
             print(f'The max number of lines is set to {self.args.limit}.')
@@ -72,6 +86,29 @@ class TranslateCmd(BaseLangIndexCmd):
             tids_and_texts = res
         return tids_and_texts, index
 
+    def prefill(self, tids_and_texts: List[Tuple[str, str]], update_func) -> List[Tuple[str, str]]:
+        """
+        Translate lines by similar lines translated before, lines whose similarity is not less than
+        translator.fuzzy_match.threshold and having the same variables and tags are translated by update_func.
+        :return: Lines left for the translator
+        """
+        threshold = (self.config['translator'].get('fuzzy_match', None) or {}).get('threshold', 0.95)
+        fuzzy_index = FuzzyIndex.from_indexes(self.args.lang)
+        st_time = time.time()
+        res, prefilled = [], []
+        for tid, text in tids_and_texts:
+            match = fuzzy_index.query(text, threshold)
+            if match is None or not match.same_markup(text):
+                res.append((tid, text))
+            else:
+                prefilled.append((tid, match.translation))
+        elapsed = time.time() - st_time
+        print(f'{len(prefilled)} lines are translated by the fuzzy translation memory (threshold: {threshold}), '
+              f'{len(res)} lines are left. [{elapsed * 1000 / max(len(tids_and_texts), 1):.3f}ms per line]')
+        if prefilled:
+            update_func(prefilled)
+        return res
+
     def parse_args(self, text: str):
         # we create new _parser as we don't know what args dose _translator.register_args
         self.reinit()
@@ -101,16 +138,23 @@ class TranslateCmd(BaseLangIndexCmd):
         self.args = self._parser.parse_args(args_list)
         self._index, self._nick_name = self.parse_index_or_name(self.args.index_or_name)
 
+    # translations of the language are decoded once for listing and updating them
+    @db_context
     def invoke(self):
         done = self._translator.do_init(self.args, default_config)
         if not done:
             print('Translation task is canceled.')
             return
-        tids_and_texts, index = self.get_untranslated_lines()
+        accept_blank = self.args.accept_blank
+        journal = RunJournal(self.name, self.get_translation_index(), self.args.lang)
+        if self.args.resume:
+            journal.resume(self.get_translation_index(), self.args.lang, discord_blank=not accept_blank,
+                           say_only=self.config.say_only)
+        tids_and_texts, index = self.get_untranslated_lines(journal.done_tids)
 
         if tids_and_texts:
             tid_map = {tid: text for tid, text in tids_and_texts}
-            accept_blank = self.args.accept_blank
+            journal.start(self.args.resume)
 
             def _update(tlist):
                 use_cnt = 0
@@ -130,7 +174,18 @@ class TranslateCmd(BaseLangIndexCmd):
                                         new_tlist.append((tid, new_text))
                                         continue
                     print(f'Find {use_cnt} translated lines, and discord {len(tlist) - use_cnt} lines')
+                    # record them before updating, so they can be recovered by --resume
+                    journal.record(new_tlist)
                     index.update_translations(self.args.lang, new_tlist,
                                               untranslated_only=True, discord_blank=accept_blank,
                                               say_only=self.config.say_only)
-            self._translator.invoke(tids_and_texts, _update)
+            if self.args.fuzzy:
+                tids_and_texts = self.prefill(tids_and_texts, _update)
+            try:
+                self._translator.invoke(tids_and_texts, _update)
+            finally:
+                journal.close()
+            # all translations are written, the run is finished
+            journal.remove()
+        else:
+            journal.remove()
@@ -14,14 +14,21 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Set
 
 import tqdm
 
 from command import BaseLangIndexCmd
+from command.translation.resume import RunJournal
 from config import default_config
-from store.database.base import flush
+from store.database.base import db_context
+from store.fuzzy import FuzzyIndex
 from store.group import group_translations_by, ALL
 from trans.openai_api import OpenAITranslator
+from translator.base.writer import TranslationWriter
 from util import strip_or_none
 from util.renpy import strip_tags, is_translatable
 
@@ -56,7 +63,69 @@ class LLMAugmentTranslateCmd(BaseLangIndexCmd):
                                   help="Accept blank translated lines from the translator when updating translations.")
         self._parser.add_argument('--limit', type=int, default=-1,
                                   help='The max number of lines to be translated. Negative values mean no limit.')
+        self._parser.add_argument('-nw', '--num_workers', type=int, default=1,
+                                  help='The number of files translated at the same time, each of them has its own '
+                                       'chat history. Larger value can improve the translation speed if your LLM '
+                                       'server can handle requests in parallel.')
+        self._parser.add_argument('--fuzzy', action='store_true',
+                                  help='Use similar lines translated before (in all TranslationIndexes) as translations '
+                                       'or examples in the chat, see translator.fuzzy_match in config.yaml.')
+        self._parser.add_argument('--resume', action='store_true',
+                                  help='Resume the last run which is stopped halfway, lines translated or discarded '
+                                       'in the last run are not translated again.')
 
+    def _claim(self, n_untrans: int):
+        with self._cnt_lock:
+            if self._stop_flag or self._cnt >= n_untrans:
+                return False
+            self._cnt += 1
+            return True
+
+    def _translate_file(self, translator: _InnerTranslator, g: list, n_untrans: int, done_tids: Set[str],
+                        journal: RunJournal, writer: TranslationWriter, bar: tqdm.tqdm):
+        """
+        Translate lines of a file in order, translations of previous lines are used as the chat history.
+        """
+        accept_blank = self.args.accept_blank
+        translator.clear_chat()
+        for d in g:
+            if d['new_text'] is None and d['tid'] in done_tids:
+                # translated in the last run
+                continue
+            if d['new_text'] is None and is_translatable(d['old_text']):
+                raw_text = strip_or_none(strip_tags(d['old_text']))
+                if raw_text is None:
+                    continue
+                else:
+                    if not self._claim(n_untrans):
+                        return
+                    match = self._fuzzy_index.query(raw_text, self._context_threshold) \
+                        if self._fuzzy_index is not None else None
+                    if match is not None and match.score >= self._threshold and match.same_markup(raw_text):
+                        new_text = match.translation
+                    else:
+                        if match is not None:
+                            # a similar line as an example
+                            translator.append_text(match.source, match.translation)
+                        new_text = translator.translate(raw_text)
+                    bar.update(1)
+                    if new_text == raw_text:
+                        print(f'Discard untranslated line: {raw_text}')
+                    else:
+                        if new_text.strip() == '' and not accept_blank:
+                            print(f'Discard blank line: {raw_text}')
+                        else:
+                            # record it before caching, so it can be recovered by --resume
+                            journal.record([(d['tid'], new_text)])
+                            writer.put([(d['tid'], new_text)])
+            else:
+                raw_text = strip_or_none(strip_tags(d['old_text']))
+                new_text = strip_or_none(strip_tags(d['new_text']))
+                if raw_text and new_text:
+                    translator.append_text(raw_text, new_text)
+
+    # translations of the language are decoded once for listing and updating them
+    @db_context
     def invoke(self):
         if self.args.auto:
             oconfig = default_config['translator']['open_ai']
@@ -77,63 +146,76 @@ class LLMAugmentTranslateCmd(BaseLangIndexCmd):
 
         n_untrans = 0
         index = self.get_translation_index()
+        accept_blank = self.args.accept_blank
+        journal = RunJournal(self.name, index, self.args.lang)
+        if self.args.resume:
+            journal.resume(index, self.args.lang, discord_blank=not accept_blank, say_only=self.config.say_only)
+        done_tids = journal.done_tids
         group_map = group_translations_by('filename', 'linenumber', ALL,
                                           index, self.args.lang, reverse=False,
                                           say_only=self.config.say_only)
         for g in group_map.values():
             for d in g:
-                if d['new_text'] is None and is_translatable(d['old_text']):
+                if d['new_text'] is None and is_translatable(d['old_text']) and d['tid'] not in done_tids:
                     n_untrans += 1
         if n_untrans == 0:
             print('No untranslated lines to translate.')
+            journal.remove()
             return
         if self.args.limit >= 0:
             print(f'The max number of lines is set to {self.args.limit}.')
             n_untrans = min(self.args.limit, n_untrans)
 
-        cnt = 0
-        translator = _InnerTranslator(model, target_lang)
-        tlist = []
-        accept_blank = self.args.accept_blank
+        self._fuzzy_index = None
+        if self.args.fuzzy:
+            fconfig = self.config['translator'].get('fuzzy_match', None) or {}
+            self._threshold = fconfig.get('threshold', 0.95)
+            self._context_threshold = min(fconfig.get('context_threshold', 0.6), self._threshold)
+            self._fuzzy_index = FuzzyIndex.from_indexes(self.args.lang)
+        num_workers = self.args.num_workers
+        max_workers = self.config['translator']['max_workers']
+        assert 1 <= num_workers <= max_workers, f'The --num_workers should be in [1, {max_workers}]'
+        num_workers = min(num_workers, len(group_map))
+        translators = queue.Queue()
+        for _ in range(num_workers):
+            translators.put(_InnerTranslator(model, target_lang))
+        if num_workers > 1:
+            print(f'Translating {len(group_map)} files with {num_workers} workers.')
+
+        # a single committer writes translations of all workers
+        def _update(tlist):
+            index.update_translations(self.args.lang, tlist, untranslated_only=True,
+                                      discord_blank=accept_blank, say_only=self.config.say_only)
+
+        writer = TranslationWriter.from_config(_update, self.config, cache_size)
+        self._cnt = 0
+        self._cnt_lock = threading.Lock()
+        self._stop_flag = False
+        journal.start(self.args.resume)
+        writer.start()
         try:
             with tqdm.tqdm(total=n_untrans, desc='Translating') as t:
-                for g in group_map.values():
-                    translator.clear_chat()
-                    for d in g:
-                        if d['new_text'] is None and is_translatable(d['old_text']):
-                            raw_text = strip_or_none(strip_tags(d['old_text']))
-                            if raw_text is None:
-                                continue
-                            else:
-                                t.update(1)
-                                cnt += 1
-                                new_text = translator.translate(raw_text)
-                                if new_text == raw_text:
-                                    print(f'Discard untranslated line: {raw_text}')
-                                else:
-                                    if new_text.strip() == '' and not accept_blank:
-                                        print(f'Discard blank line: {raw_text}')
-                                    else:
-                                        tlist.append((d['tid'], new_text))
-                                if cnt > n_untrans:
-                                    break
-                                if cnt % cache_size == 0 and tlist:
-                                    index.update_translations(self.args.lang, tlist, untranslated_only=True,
-                                                              discord_blank=accept_blank, say_only=self.config.say_only)
-                                    tlist = []
-                                    print('Flushing...')
-                                    flush()
-                        else:
-                            raw_text = strip_or_none(strip_tags(d['old_text']))
-                            new_text = strip_or_none(strip_tags(d['new_text']))
-                            if raw_text and new_text:
-                                translator.append_text(raw_text, new_text)
-                    if cnt > n_untrans:
-                        break
+                def _task(g):
+                    translator = translators.get()
+                    try:
+                        self._translate_file(translator, g, n_untrans, done_tids, journal, writer, t)
+                    finally:
+                        translators.put(translator)
 
+                with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                    futures = [executor.submit(_task, g) for g in group_map.values()]
+                    try:
+                        for f in futures:
+                            f.result()
+                    finally:
+                        # stop other workers if one of them is failed or interrupted
+                        self._stop_flag = True
         finally:
-            translator.close()
-        if tlist:
-            index.update_translations(self.args.lang, tlist,
-                                      untranslated_only=True, discord_blank=accept_blank,
-                                      say_only=self.config.say_only)
+            try:
+                writer.close()
+            finally:
+                while not translators.empty():
+                    translators.get().close()
+                journal.close()
+        # all translations are written, the run is finished
+        journal.remove()
@@ -0,0 +1,128 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import List, Tuple, Set
+
+from config import default_config
+from store import TranslationIndex
+
+
+class RunJournal:
+    """
+    A journal of a translation run, saved in the tmp_path. Each line is a json record:
+        {"h": {"cmd": ..., "nickname": ..., "tag": ..., "lang": ...}} the header,
+        {"r": [[tid, new_text], ...]} translations written to the index.
+    A run resumed from the journal re-applies recorded translations and skips their tids. Lines discarded by
+    the last run (e.g., untranslated or blank lines) are not recorded, so they are translated again.
+    """
+
+    def __init__(self, cmd: str, index: TranslationIndex, lang: str):
+        key = hashlib.sha1(f'{index.nickname}:{index.tag}:{lang}'.encode('utf-8')).hexdigest()[:16]
+        self.journal_file = os.path.join(default_config.tmp_path, f'{cmd}_{key}.journal')
+        self.header = {'cmd': cmd, 'nickname': index.nickname, 'tag': index.tag, 'lang': lang}
+        self.translations: List[Tuple[str, str]] = []
+        self.done_tids: Set[str] = set()
+        self._lock = threading.Lock()
+        self._file = None
+        self._loaded = False
+
+    def exists(self):
+        return os.path.isfile(self.journal_file)
+
+    def load(self):
+        """
+        Load records of the last run.
+        :return: False if there is no valid journal of the last run
+        """
+        self.translations, self.done_tids = [], set()
+        self._loaded = False
+        if not self.exists():
+            return False
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a record partly written when the last run was killed
+                    logging.warning(f'Ignoring a broken record in {self.journal_file}')
+                    break
+                if i == 0:
+                    if record.get('h', None) != self.header:
+                        print(f'The journal ({self.journal_file}) does not belong to this run.')
+                        return False
+                elif 'r' in record:
+                    self.translations.extend((tid, text) for tid, text in record['r'])
+                    self.done_tids.update(tid for tid, _ in record['r'])
+        self._loaded = True
+        return True
+
+    def resume(self, index: TranslationIndex, lang: str, **update_kwargs):
+        """
+        Load the journal of the last run, and apply its translations to the index.
+        :param update_kwargs: kwargs for TranslationIndex.update_translations
+        """
+        if not self.load():
+            print('No run to resume, starting a new run.')
+            return
+        if self.translations:
+            index.update_translations(lang, self.translations, untranslated_only=True, **update_kwargs)
+        print(f'Resuming from {self.journal_file}: {len(self.translations)} translated lines are recovered.')
+
+    def _append(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.journal_file, 'a', encoding='utf-8')
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def start(self, resume: bool):
+        """
+        Start recording, the journal of the last run is discarded unless resuming from it.
+        """
+        if not resume or not self._loaded:
+            self.remove()
+            self._append({'h': self.header})
+            return
+        # rewrite loaded records, a broken record at the end is dropped, so new records can be appended
+        self.close()
+        tmp_file = self.journal_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for record in ({'h': self.header}, {'r': [list(t) for t in self.translations]}):
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.journal_file)
+
+    def record(self, tids_and_text: List[Tuple[str, str]]):
+        if tids_and_text:
+            self._append({'r': [list(t) for t in tids_and_text]})
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def remove(self):
+        self.close()
+        if self.exists():
+            os.remove(self.journal_file)
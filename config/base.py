@@ -31,6 +31,8 @@ class ProjzConfig:
     PROJECT_PATH = './projz'
     TMP_PATH = './projz/tmp'
     WRITE_CACHE_SIZE = 500
+    WRITE_JOURNAL = True
+    DB_ENGINE = 'tinydb'
     REMOVE_TAGS = False
     SAY_ONLY = True
     NUM_WORKERS = 2
@@ -104,6 +106,18 @@ class ProjzConfig:
             return self['index']['write_cache_size']
         return self.WRITE_CACHE_SIZE
 
+    @property
+    def write_journal(self):
+        if self.cfg:
+            return self['index'].get('write_journal', self.WRITE_JOURNAL)
+        return self.WRITE_JOURNAL
+
+    @property
+    def db_engine(self):
+        if self.cfg:
+            return self['index'].get('db_engine', self.DB_ENGINE)
+        return self.DB_ENGINE
+
     @property
     def remove_tags(self):
         if self.cfg:
@@ -86,7 +86,8 @@ class TranslationRunner(threading.Thread):
                     new_texts = self._translator.translate_batch(texts)
                     for p, t in zip(packs, new_texts):
                         p['new_text'] = t
-                    self._update_func(packs)
+                    # rejected lines are not cached, so they are translated again when they show up
+                    self._update_func([p for p in packs if p['new_text'] is not None])
             except Exception as e:
                 logging.exception(e)
                 self._close_translator()
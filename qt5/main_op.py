@@ -404,7 +404,7 @@ class InitTranslator(QThread):
         try:
             provider = get_provider(self._provider)
             if provider:
-                translator = provider.translator_of(self._api, self._source, self._target)
+                translator = provider.memorized_translator_of(self._api, self._source, self._target)
         except Exception as e:
             logging.exception(e)
         self.trigger.emit((translator, self._font))
@@ -15,17 +15,33 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import logging
 import threading
-from typing import Iterable, Union, Callable, Mapping, Tuple, List
+from typing import Iterable, Union, Callable, Mapping, Tuple, List, Any
 
 from tinydb import TinyDB, JSONStorage, Storage
 from tinydb.middlewares import CachingMiddleware
 from tinydb.table import Table
 
 from config import default_config
+from store.database.journal import JournaledCachingMiddleware
+from store.database.storage import LazyJSONStorage
 
 _DB_POOL = dict()
 _CONTEXT_CNT = 0
 _CONTEXT_LOCK = threading.Lock()
+# functions called when all contexts exit
+_EXIT_HOOKS = []
+
+
+def on_context_exit(func: Callable[[], None]):
+    """
+    Register a function called when all contexts exit, e.g. for clearing data cached in a db_context.
+    The function is called with the context lock held, so it must not open any db.
+    """
+    _EXIT_HOOKS.append(func)
+
+
+def in_db_context():
+    return _CONTEXT_CNT > 0
 
 
 def _enter_context():
@@ -47,6 +63,24 @@ def _clear_dbs():
         except Exception as e:
             logging.exception(e)
     _DB_POOL.clear()
+    for hook in _EXIT_HOOKS:
+        try:
+            hook()
+        except Exception as e:
+            logging.exception(e)
+
+
+def _flush_db(db):
+    if isinstance(db, TinyDB):
+        # TinyDB has no flush(), cached data is held by its storage
+        storage = db.storage
+        if hasattr(storage, 'sync'):
+            # a journaled storage only rewrites the db file when necessary
+            storage.sync()
+        else:
+            storage.flush()
+    else:
+        db.flush()
 
 
 def flush():
@@ -61,7 +95,7 @@ def flush():
     for k, v in _DB_POOL.items():
         try:
             logging.debug(f'Flush db: {k}, num_holders: {v[1]}')
-            v[0].flush()
+            _flush_db(v[0])
         except Exception as e:
             logging.exception(e)
 
@@ -81,7 +115,17 @@ def _exit_context():
     _CONTEXT_LOCK.release()
 
 
-def _get_or_create(db_file: str):
+def _open_tinydb(db_file: str):
+    return TinyDB(db_file, encoding='utf-8', ensure_ascii=False, storage=CachingMiddleware(JSONStorage))
+
+
+def _open_journaled_tinydb(db_file: str):
+    # tables of translations are decoded on demand
+    return TinyDB(db_file, encoding='utf-8', ensure_ascii=False,
+                  storage=JournaledCachingMiddleware(LazyJSONStorage))
+
+
+def _get_or_create(db_file: str, create_func: Callable[[str], Any] = _open_tinydb):
     global _CONTEXT_CNT
     _CONTEXT_LOCK.acquire()
 
@@ -95,7 +139,7 @@ def _get_or_create(db_file: str):
             _DB_POOL[db_file] = (db, cnt)
         else:
             logging.debug(f'Create db: {db_file}')
-            db = TinyDB(db_file, encoding='utf-8', ensure_ascii=False, storage=CachingMiddleware(JSONStorage))
+            db = create_func(db_file)
             _DB_POOL[db_file] = (db, 1)
         return db
     finally:
@@ -124,6 +168,24 @@ def _release(db_file: str):
         _CONTEXT_LOCK.release()
 
 
+def discard(db_file: str):
+    """
+    write cached data of the given db to disk, then close it and remove it from the pool
+    :param db_file:
+    :return:
+    """
+    _CONTEXT_LOCK.acquire()
+    try:
+        if db_file in _DB_POOL:
+            db, cnt = _DB_POOL[db_file]
+            assert cnt <= 0, f'The db({db_file}) is still held by {cnt} holder(s)'
+            logging.debug(f'Discard db: {db_file}')
+            _DB_POOL.pop(db_file)
+            db.close()
+    finally:
+        _CONTEXT_LOCK.release()
+
+
 def db_context(func):
     def wrapper(*args, **kwargs):
         _enter_context()
@@ -140,15 +202,24 @@ class BaseDao:
         self.db_file = db_file
         self.db = None
 
-    def __enter__(self):
+    def _create_db(self, db_file: str):
         # Using a CachingMiddleware to improves speed by reducing disk I/O
-        self.db = _get_or_create(self.db_file)
+        return _open_tinydb(db_file)
+
+    def __enter__(self):
+        self.db = _get_or_create(self.db_file, self._create_db)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         _release(self.db_file)
         return False
 
+    def flush(self):
+        """
+        write cached data of this db to disk immediately
+        """
+        _flush_db(self.db)
+
 
 class ProjzTable(Table):
     def __init__(self, storage: Storage, name: str):
@@ -14,12 +14,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import os
-from typing import List
+from collections import defaultdict
+from typing import List, Tuple, Dict, Iterable
 
 from tinydb import where, Query
+from tinydb.table import Document
 
 from config import default_config
 from store.database import BaseDao
+from store.database.base import discard, _open_journaled_tinydb
+from store.database.journal import JOURNAL_SUFFIX
+from store.database.storage import MANIFEST_SUFFIX
+from store.database.sqlite import SqliteDB, engine_of, SQLITE_ENGINE, TINYDB_ENGINE
 
 
 def return_first(arr):
@@ -27,10 +33,60 @@ def return_first(arr):
 
 
 class TranslationIndexDao(BaseDao):
+    # A table of a single document mapping nickname -> {tag -> doc_id} for the TranslationIndexes,
+    # which is maintained on add, update and delete, so that resolving a nickname doesn't scan all of them.
+    LOOKUP_TABLE = 'projz_lookup'
+    _LOOKUP_DOCID = 1
+    # the key of None tag, the tag of a TranslationIndex is None or a non-blank string
+    _NONE_TAG = ''
+
     def __init__(self):
         super().__init__(os.path.join(default_config.project_path, 'index.db'))
         # self.db = TinyDB('db.json')
 
+    @classmethod
+    def _tag_key(cls, tag: str):
+        return cls._NONE_TAG if tag is None else tag
+
+    def _rebuild_lookup(self):
+        names = defaultdict(dict)
+        for i in self.db.all():
+            names[i.get('nickname', None)].setdefault(self._tag_key(i.get('tag', None)), i.doc_id)
+        lookup = {'names': dict(names), 'size': len(self.db)}
+        self.db.drop_table(self.LOOKUP_TABLE)
+        self.db.table(self.LOOKUP_TABLE).insert(Document(lookup, self._LOOKUP_DOCID))
+        return lookup
+
+    def _lookup(self):
+        lookup = self.db.table(self.LOOKUP_TABLE).get(doc_id=self._LOOKUP_DOCID)
+        if lookup is None or lookup.get('size', None) != len(self.db):
+            # created by an older version, or index.db is modified by others
+            lookup = self._rebuild_lookup()
+        return lookup
+
+    def _save_lookup(self, lookup: dict):
+        lookup['size'] = len(self.db)
+        self.db.table(self.LOOKUP_TABLE).update(lookup, doc_ids=[self._LOOKUP_DOCID])
+
+    def _lookup_add(self, lookup: dict, nickname: str, tag: str, doc_id: int):
+        lookup['names'].setdefault(nickname, dict())[self._tag_key(tag)] = doc_id
+
+    def _lookup_remove(self, lookup: dict, nickname: str, tag: str, doc_id: int):
+        tags = lookup['names'].get(nickname, None)
+        if tags is not None and tags.get(self._tag_key(tag), None) == doc_id:
+            tags.pop(self._tag_key(tag))
+            if not tags:
+                lookup['names'].pop(nickname)
+
+    def _find(self, nickname: str, tag: str = None, any_tag: bool = False):
+        tags = self._lookup()['names'].get(nickname, None)
+        if not tags:
+            return None
+        if any_tag:
+            # the first one as a query does
+            return min(tags.values())
+        return tags.get(self._tag_key(tag), None)
+
     def list(self):
         res = self.db.all()
         return [(i.doc_id, i) for i in res]
@@ -40,12 +96,17 @@ class TranslationIndexDao(BaseDao):
         if doc_id is not None:
             res = self.db.get(doc_id=doc_id)
         if res is None and nickname is not None:
-            if tag is None:
-                return self.db.get((where('nickname') == nickname))
-            return self.db.get((where('nickname') == nickname) & (where('tag') == tag))
+            found_id = self._find(nickname, tag, any_tag=tag is None)
+            if found_id is not None:
+                return self.db.get(doc_id=found_id)
         return res
 
     def contains(self, data: dict, exclude_docid: int = None):
+        if 'nickname' in data and set(data.keys()) <= {'nickname', 'tag'}:
+            found_id = self._find(data['nickname'], data.get('tag', None), any_tag='tag' not in data)
+            if found_id is None:
+                return False
+            return exclude_docid is None or found_id != exclude_docid
         if exclude_docid is None:
             return self.db.contains(Query().fragment(data))
         else:
@@ -55,16 +116,37 @@ class TranslationIndexDao(BaseDao):
             return False
 
     def add(self, indexe_dict: dict):
-        return self.db.insert(indexe_dict)
+        lookup = self._lookup()
+        doc_id = self.db.insert(indexe_dict)
+        self._lookup_add(lookup, indexe_dict.get('nickname', None), indexe_dict.get('tag', None), doc_id)
+        self._save_lookup(lookup)
+        return doc_id
 
     def update(self, data: dict, doc_id: int):
-        return self.db.update(data, doc_ids=[doc_id])
+        if 'nickname' not in data and 'tag' not in data:
+            return self.db.update(data, doc_ids=[doc_id])
+        lookup = self._lookup()
+        old = self.db.get(doc_id=doc_id)
+        res = self.db.update(data, doc_ids=[doc_id])
+        if old is not None:
+            self._lookup_remove(lookup, old.get('nickname', None), old.get('tag', None), doc_id)
+            new = self.db.get(doc_id=doc_id)
+            self._lookup_add(lookup, new.get('nickname', None), new.get('tag', None), doc_id)
+            self._save_lookup(lookup)
+        return res
 
     def delete(self, doc_id: int):
-        return self.db.remove(doc_ids=[doc_id])
+        lookup = self._lookup()
+        old = self.db.get(doc_id=doc_id)
+        res = self.db.remove(doc_ids=[doc_id])
+        if old is not None:
+            self._lookup_remove(lookup, old.get('nickname', None), old.get('tag', None), doc_id)
+        self._save_lookup(lookup)
+        return res
 
     def delete_all(self):
         self.db.truncate()
+        self.db.drop_table(self.LOOKUP_TABLE)
 
     @classmethod
     def open(cls):
@@ -76,6 +158,21 @@ class TranslationDao(BaseDao):
         super().__init__(db_file)
         # self.db = TinyDB('db.json')
 
+    def _create_db(self, db_file: str):
+        # Pending records of the journal are always replayed on open, even if index.write_journal is disabled
+        return _open_journaled_tinydb(db_file)
+
+    def _log(self, records: List[dict]):
+        # Block updates are journaled, so a large write cache is safe
+        if default_config.write_journal:
+            self.db.storage.log(records)
+
+    def durable_writes(self):
+        """
+        :return: True if block updates survive a crash once they are written, without flushing the db
+        """
+        return default_config.write_journal
+
     def add_batch(self, table_name: str, batch_data: List[dict]):
         return self.db.table(table_name).insert_multiple(batch_data)
 
@@ -83,14 +180,111 @@ class TranslationDao(BaseDao):
         return self.db.drop_table(table_name)
 
     def update_block(self, table_name: str, doc_id: int, blocks: List[dict]):
+        self._log([{'t': table_name, 'd': doc_id, 'b': blocks}])
         return self.db.table(table_name).update({'block': blocks}, doc_ids=[doc_id])
 
     def update_blocks(self, table_name: str, doc_ids: List[int], blocks: List[List[dict]]):
         update_cols = []
         for block, doc_id in zip(blocks, doc_ids):
             update_cols.append([{'block': block}, doc_id])
+        self._log([{'t': table_name, 'd': doc_id, 'b': block} for block, doc_id in update_cols])
         return self.db.table(table_name).update_multiple_by_id(update_cols)
 
+    def select_blocks(self, table_name: str, keys: Iterable[Tuple[int, int]]) -> Dict[Tuple[int, int], dict]:
+        """
+        Select blocks by their (doc_id, block_idx), which is what a tid encodes.
+
+        :return: A dict mapping each found (doc_id, block_idx) to its block
+        """
+        res = dict()
+        if table_name in self.list_langs():
+            table = self.db.table(table_name)
+            docs = dict()
+            for doc_id, block_idx in keys:
+                if doc_id not in docs:
+                    docs[doc_id] = table.get(doc_id=doc_id)
+                doc = docs[doc_id]
+                if doc is not None and 0 <= block_idx < len(doc['block']):
+                    res[(doc_id, block_idx)] = doc['block'][block_idx]
+        return res
+
+    def replace_blocks(self, table_name: str, updates: Iterable[Tuple[int, int, dict]]):
+        """
+        Replace blocks by their (doc_id, block_idx).
+        Blocks are replaced in the cached table in place, instead of rebuilding the whole table by
+        Table.update(). The table is still serialized as a whole when the cache is flushed (every
+        write_cache_size writes, or when the journal is compacted), use the migrate cmd to convert the db
+        into the SQLite format, which writes the updated rows only.
+
+        :param updates: List[(doc_id, block_idx, block)]
+        :return: The number of updated blocks
+        """
+        records = [{'t': table_name, 'd': doc_id, 'i': block_idx, 'b': block}
+                   for doc_id, block_idx, block in updates]
+        tables = self.db.storage.read()
+        if not tables or table_name not in tables:
+            return 0
+        raw_table = tables[table_name]
+        self._log(records)
+        n_updated = 0
+        for r in records:
+            doc = raw_table.get(str(r['d']), None)
+            if doc is not None and 0 <= r['i'] < len(doc['block']):
+                doc['block'][r['i']] = r['b']
+                n_updated += 1
+        # let the CachingMiddleware count the write, the cache is modified already
+        self.db.storage.write(tables)
+        self.db.table(table_name).clear_cache()
+        return n_updated
+
+    def copy_table(self, table_name: str, target_name: str, fields: dict = None):
+        """
+        Copy a table with the same doc_ids, the target table is replaced if it exists.
+        On TinyDB, the source table is decoded (if it's not yet) and every document is copied, as the fields
+        of each document are set. Only the SQLite engine copies rows without decoding them.
+
+        :param fields: Fields to set in each copied document, e.g. {'language': ...}
+        :return: The number of copied documents
+        """
+        tables = self.db.storage.read()
+        if not tables or table_name not in tables:
+            return 0
+        if fields is None:
+            fields = dict()
+        # copy blocks as well, they are updated in place
+        tables[target_name] = {k: dict(v, block=[dict(b) for b in v['block']], **fields)
+                               for k, v in tables[table_name].items()}
+        self.db.storage.write(tables)
+        self._reset_table(target_name)
+        return len(tables[target_name])
+
+    def _reset_table(self, table_name: str):
+        # drop the cached Table object, whose query cache and _next_id are of the replaced table
+        self.db._tables.pop(table_name, None)
+
+    def rename_table(self, table_name: str, target_name: str, fields: dict = None):
+        """
+        Rename a table, documents are moved without being copied. The target table is replaced if it exists.
+        On TinyDB, the source table is decoded (if it's not yet) to set the fields of each document.
+
+        :param fields: Fields to set in each renamed document, e.g. {'language': ...}
+        :return: The number of renamed documents
+        """
+        tables = self.db.storage.read()
+        if not tables or table_name not in tables:
+            return 0
+        docs = tables[table_name]
+        if fields:
+            for v in docs.values():
+                v.update(fields)
+        tables[target_name] = docs
+        del tables[table_name]
+        self.db.storage.write(tables)
+        # remove the cached table objects, the table is not in the db now
+        self._reset_table(table_name)
+        self._reset_table(target_name)
+        return len(docs)
+
     def list_langs(self):
         return self.db.tables()
 
@@ -121,4 +315,110 @@ class TranslationDao(BaseDao):
 
     @classmethod
     def open(cls, db_file: str):
-        return cls(db_file)
+        """
+        Open a TranslationDao with the storage engine of the given db file.
+        A new db file is created with the engine specified by index.db_engine in config.yaml.
+        """
+        if engine_of(db_file, default_config.db_engine) == SQLITE_ENGINE:
+            return SqliteTranslationDao(db_file)
+        return TranslationDao(db_file)
+
+
+class SqliteTranslationDao(TranslationDao):
+    def __init__(self, db_file: str):
+        super().__init__(db_file)
+
+    def _create_db(self, db_file: str):
+        return SqliteDB(db_file)
+
+    def add_batch(self, table_name: str, batch_data: List[dict]):
+        return self.db.insert_multiple(table_name, batch_data)
+
+    def delete_by_lang(self, table_name: str):
+        return self.db.drop_table(table_name)
+
+    def update_block(self, table_name: str, doc_id: int, blocks: List[dict]):
+        return self.db.update_multiple_by_id(table_name, [({'block': blocks}, doc_id)])
+
+    def update_blocks(self, table_name: str, doc_ids: List[int], blocks: List[List[dict]]):
+        return self.db.update_multiple_by_id(table_name, [({'block': b}, i) for b, i in zip(blocks, doc_ids)])
+
+    def select_blocks(self, table_name: str, keys: Iterable[Tuple[int, int]]) -> Dict[Tuple[int, int], dict]:
+        return self.db.get_blocks(table_name, keys)
+
+    def replace_blocks(self, table_name: str, updates: Iterable[Tuple[int, int, dict]]):
+        return self.db.update_blocks(table_name, updates)
+
+    def durable_writes(self):
+        # each write is committed
+        return True
+
+    def copy_table(self, table_name: str, target_name: str, fields: dict = None):
+        return self.db.copy_table(table_name, target_name, fields)
+
+    def rename_table(self, table_name: str, target_name: str, fields: dict = None):
+        return self.db.rename_table(table_name, target_name, fields)
+
+    def list_langs(self):
+        return self.db.tables()
+
+    def list_by_lang(self, table_name: str):
+        return self.db.all(table_name)
+
+    def select_first_by_docid(self, table_name: str, doc_id: int):
+        return self.db.get(table_name, doc_id)
+
+    def select_first_by_identifier(self, table_name: str, identifier: str):
+        return self.db.get_by_identifier(table_name, identifier)
+
+    def contains_with_docid(self, table_name: str, doc_id: int):
+        return self.select_first_by_docid(table_name, doc_id) is not None
+
+    def contains_with_identifier(self, table_name: str, identifier: str):
+        return self.select_first_by_identifier(table_name, identifier) is not None
+
+
+def migrate_to_sqlite(db_file: str, backup_file: str = None):
+    """
+    Convert a TinyDB db file into the SQLite format. The doc_id of each document is preserved,
+    so tids of translations (and files saved with them) remain valid after migration.
+
+    :param db_file: The TinyDB db file
+    :param backup_file: Where to keep the original file. Default to {db_file}.bak
+    :return: The number of migrated documents
+    """
+    if engine_of(db_file, SQLITE_ENGINE) != TINYDB_ENGINE:
+        return 0
+    # make sure all cached data is written to disk
+    discard(db_file)
+    if backup_file is None:
+        backup_file = db_file + '.bak'
+    tmp_file = db_file + '.tmp'
+    if os.path.isfile(tmp_file):
+        os.remove(tmp_file)
+    n_docs = 0
+    # pending block updates in the journal are replayed on open
+    src = _open_journaled_tinydb(db_file)
+    dst = SqliteDB(tmp_file)
+    try:
+        for table_name in src.tables():
+            docs = src.table(table_name).all()
+            # keep the original doc_id
+            dst.insert_documents(table_name, [(d.doc_id, d) for d in docs])
+            n_docs += len(docs)
+    finally:
+        src.close()
+        dst.close()
+    os.replace(db_file, backup_file)
+    os.replace(tmp_file, db_file)
+    remove_sidecar_files(db_file)
+    return n_docs
+
+
+def remove_sidecar_files(db_file: str):
+    """
+    Remove the journal and manifest files of a TinyDB db file.
+    """
+    for suffix in [JOURNAL_SUFFIX, MANIFEST_SUFFIX]:
+        if os.path.isfile(db_file + suffix):
+            os.remove(db_file + suffix)
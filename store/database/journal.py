@@ -0,0 +1,185 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+import logging
+import os
+import threading
+from typing import List, Mapping, Iterable
+
+from tinydb.middlewares import CachingMiddleware
+
+JOURNAL_SUFFIX = '.journal'
+
+
+def _dumps(data) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def _same_source(old_block: Mapping, new_block: Mapping):
+    # Only the translation (new_code) of a block is updated in the journal, the source must stay the same
+    return old_block.get('type', None) == new_block.get('type', None) and \
+        old_block.get('what', None) == new_block.get('what', None)
+
+
+class WriteAheadJournal:
+    """
+    An append-only file of block updates which are not yet written to the db file.
+    Each record is a json line:
+        {"t": table_name, "d": doc_id, "i": block_idx, "b": block} for a single block, or
+        {"t": table_name, "d": doc_id, "b": [block, ...]} for all blocks of a document.
+    """
+
+    def __init__(self, journal_file: str):
+        self.journal_file = journal_file
+        self._lock = threading.Lock()
+        self._file = None
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.journal_file, 'a', encoding='utf-8')
+        return self._file
+
+    def append(self, records: Iterable[dict]):
+        """
+        Append records and fsync them, so they survive a crash once this method returns.
+        """
+        lines = [_dumps(r) + '\n' for r in records]
+        if not lines:
+            return
+        with self._lock:
+            f = self._open()
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self) -> List[dict]:
+        records = []
+        if not os.path.isfile(self.journal_file):
+            return records
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A partly written record at the end of the journal, it was not acknowledged
+                    logging.warning(f'Ignoring a broken record in {self.journal_file}')
+                    break
+        return records
+
+    def truncate(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if os.path.isfile(self.journal_file):
+                os.remove(self.journal_file)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def replay(data: dict, records: Iterable[dict]):
+    """
+    Apply journal records to the data of a TinyDB db.
+
+    :return: The number of applied records
+    """
+    n_applied = 0
+    for r in records:
+        doc = data.get(r['t'], {}).get(str(r['d']), None)
+        if doc is None:
+            continue
+        blocks = doc.get('block', [])
+        if 'i' in r:
+            i, block = r['i'], r['b']
+            if 0 <= i < len(blocks) and _same_source(blocks[i], block):
+                blocks[i] = block
+                n_applied += 1
+        elif len(blocks) == len(r['b']) and all(_same_source(o, n) for o, n in zip(blocks, r['b'])):
+            doc['block'] = r['b']
+            n_applied += 1
+    return n_applied
+
+
+class JournaledCachingMiddleware(CachingMiddleware):
+    """
+    A CachingMiddleware that records block updates in a WriteAheadJournal before they are applied to the cache.
+    The journal is replayed when the db is opened. It's compacted into the db file inline at flush points
+    (when the write cache is full, the dbs are flushed or closed), there is no background compaction.
+    """
+
+    def __init__(self, storage_cls):
+        super().__init__(storage_cls)
+        self.journal = None
+        self._n_journaled = 0
+        self._unjournaled = False
+
+    def __call__(self, *args, **kwargs):
+        super().__call__(*args, **kwargs)
+        self.journal = WriteAheadJournal(args[0] + JOURNAL_SUFFIX)
+        return self
+
+    def log(self, records: Iterable[dict]):
+        """
+        Record the block updates of the next write before it is applied to the cache.
+        """
+        self.journal.append(records)
+        self._n_journaled += 1
+
+    def read(self):
+        if self.cache is None:
+            self.cache = self.storage.read()
+            records = self.journal.read()
+            if records:
+                if self.cache is None:
+                    self.cache = dict()
+                n_applied = replay(self.cache, records)
+                logging.info(f'Replayed {n_applied}/{len(records)} journal record(s) of {self.journal.journal_file}')
+                # compact the replayed records into the db file
+                self._cache_modified_count += 1
+                self._unjournaled = True
+                self.flush()
+        return self.cache
+
+    def write(self, data):
+        if self._n_journaled > 0:
+            self._n_journaled -= 1
+        else:
+            self._unjournaled = True
+        super().write(data)
+
+    def sync(self):
+        """
+        Make all writes durable. Block updates are already durable in the journal, so the db file is rewritten
+        only if there are writes which are not journaled (e.g. inserting or dropping tables).
+        """
+        if self._unjournaled:
+            self.flush()
+
+    def flush(self):
+        super().flush()
+        # compact the journal: all of its records are in the db file now
+        self.journal.truncate()
+        self._unjournaled = False
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.journal.close()
@@ -0,0 +1,293 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+import sqlite3
+import threading
+from typing import List, Iterable, Tuple, Mapping
+
+from tinydb.table import Document
+
+SQLITE_ENGINE = 'sqlite'
+TINYDB_ENGINE = 'tinydb'
+_SQLITE_HEADER = b'SQLite format 3\x00'
+
+_SCHEMA_VERSION = 2
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS projz_tables(
+    name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS projz_documents(
+    tbl TEXT NOT NULL,
+    doc_id INTEGER NOT NULL,
+    identifier TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (tbl, doc_id)
+);
+CREATE INDEX IF NOT EXISTS projz_documents_identifier ON projz_documents(tbl, identifier);
+CREATE TABLE IF NOT EXISTS projz_blocks(
+    tbl TEXT NOT NULL,
+    doc_id INTEGER NOT NULL,
+    block_idx INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (tbl, doc_id, block_idx)
+) WITHOUT ROWID;
+'''
+
+
+def engine_of(db_file: str, default: str = TINYDB_ENGINE):
+    """
+    Detect the storage engine of a db file by its header.
+
+    :param db_file: The db file
+    :param default: The engine returned when the file is missing or empty
+    :return: SQLITE_ENGINE or TINYDB_ENGINE
+    """
+    try:
+        with open(db_file, 'rb') as f:
+            header = f.read(len(_SQLITE_HEADER))
+    except FileNotFoundError:
+        return default
+    if len(header) == 0:
+        return default
+    return SQLITE_ENGINE if header == _SQLITE_HEADER else TINYDB_ENGINE
+
+
+def _dumps(data) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+class SqliteDB:
+    """
+    A SQLite-backed database with the subset of the TinyDB API used by TranslationDao.
+    Each block of a document is stored in its own row keyed by (table, doc_id, block_idx),
+    which is exactly what a tid encodes, so reading or updating a translation line only
+    touches its own row instead of the whole database.
+    """
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._init_schema()
+
+    def _init_schema(self):
+        with self._lock, self._conn:
+            version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+            if version > _SCHEMA_VERSION:
+                raise RuntimeError(f'Unsupported schema version({version}) of {self.db_file}, '
+                                   f'please upgrade this program.')
+            for statement in _SCHEMA.split(';'):
+                if statement.strip():
+                    self._conn.execute(statement)
+            self._conn.execute(f'PRAGMA user_version={_SCHEMA_VERSION}')
+
+    def _insert_rows(self, name: str, documents: Iterable[Tuple[int, Mapping]]):
+        doc_rows, block_rows = [], []
+        for doc_id, d in documents:
+            fields = {k: v for k, v in d.items() if k != 'block'}
+            doc_rows.append((name, doc_id, d.get('identifier', None), _dumps(fields)))
+            for i, b in enumerate(d.get('block', [])):
+                block_rows.append((name, doc_id, i, _dumps(b)))
+        self._conn.executemany('INSERT INTO projz_documents(tbl, doc_id, identifier, data) VALUES (?,?,?,?)',
+                               doc_rows)
+        self._conn.executemany('INSERT INTO projz_blocks(tbl, doc_id, block_idx, data) VALUES (?,?,?,?)',
+                               block_rows)
+
+    def _load_blocks(self, name: str, doc_id: int):
+        cursor = self._conn.execute('SELECT data FROM projz_blocks WHERE tbl=? AND doc_id=? ORDER BY block_idx',
+                                    (name, doc_id))
+        return [json.loads(r[0]) for r in cursor]
+
+    def _to_document(self, name: str, row):
+        if row is None:
+            return None
+        doc_id, data = row
+        doc = json.loads(data)
+        doc['block'] = self._load_blocks(name, doc_id)
+        return Document(doc, doc_id)
+
+    def tables(self):
+        with self._lock:
+            return {r[0] for r in self._conn.execute('SELECT name FROM projz_tables')}
+
+    def _delete_rows(self, name: str):
+        self._conn.execute('DELETE FROM projz_blocks WHERE tbl=?', (name,))
+        self._conn.execute('DELETE FROM projz_documents WHERE tbl=?', (name,))
+        self._conn.execute('DELETE FROM projz_tables WHERE name=?', (name,))
+
+    def drop_table(self, name: str):
+        with self._lock, self._conn:
+            self._delete_rows(name)
+
+    def _renamed_documents(self, name: str, target_name: str, fields: Mapping = None):
+        # only fields of documents are decoded, their blocks are not
+        cursor = self._conn.execute('SELECT doc_id, identifier, data FROM projz_documents WHERE tbl=?', (name,))
+        for doc_id, identifier, data in cursor.fetchall():
+            if fields:
+                d = json.loads(data)
+                d.update(fields)
+                data = _dumps(d)
+            yield target_name, doc_id, identifier, data
+
+    def copy_table(self, name: str, target_name: str, fields: Mapping = None) -> int:
+        """
+        Copy a table with the same doc_ids, blocks are copied without being decoded.
+        The target table is replaced if it exists.
+
+        :param fields: Fields to set in each copied document
+        :return: The number of copied documents
+        """
+        with self._lock, self._conn:
+            assert name != target_name, f'Cannot replace the table {name} with itself'
+            if name not in self.tables():
+                return 0
+            self._delete_rows(target_name)
+            self._conn.execute('INSERT INTO projz_tables(name) VALUES (?)', (target_name,))
+            cursor = self._conn.executemany('INSERT INTO projz_documents(tbl, doc_id, identifier, data) '
+                                            'VALUES (?,?,?,?)', self._renamed_documents(name, target_name, fields))
+            self._conn.execute('INSERT INTO projz_blocks(tbl, doc_id, block_idx, data) '
+                               'SELECT ?, doc_id, block_idx, data FROM projz_blocks WHERE tbl=?', (target_name, name))
+            return cursor.rowcount
+
+    def rename_table(self, name: str, target_name: str, fields: Mapping = None) -> int:
+        """
+        Rename a table, blocks are moved without being decoded.
+        The target table is replaced if it exists.
+
+        :param fields: Fields to set in each renamed document
+        :return: The number of renamed documents
+        """
+        with self._lock, self._conn:
+            assert name != target_name, f'Cannot replace the table {name} with itself'
+            if name not in self.tables():
+                return 0
+            self._delete_rows(target_name)
+            cursor = self._conn.executemany('UPDATE projz_documents SET tbl=?, identifier=?, data=? '
+                                            'WHERE tbl=? AND doc_id=?',
+                                            [(t, i, d, name, doc_id) for t, doc_id, i, d in
+                                             self._renamed_documents(name, target_name, fields)])
+            self._conn.execute('UPDATE projz_blocks SET tbl=? WHERE tbl=?', (target_name, name))
+            self._conn.execute('UPDATE projz_tables SET name=? WHERE name=?', (target_name, name))
+            return cursor.rowcount
+
+    def insert_multiple(self, name: str, documents: Iterable[Mapping]) -> List[int]:
+        with self._lock, self._conn:
+            last_id = self._conn.execute('SELECT MAX(doc_id) FROM projz_documents WHERE tbl=?',
+                                         (name,)).fetchone()[0]
+            doc_id = 0 if last_id is None else last_id
+            docs = []
+            for d in documents:
+                doc_id += 1
+                docs.append((doc_id, d))
+            self.insert_documents(name, docs)
+            return [i for i, _ in docs]
+
+    def insert_documents(self, name: str, documents: Iterable[Tuple[int, Mapping]]):
+        """
+        Insert documents with the given doc_ids.
+        """
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR IGNORE INTO projz_tables(name) VALUES (?)', (name,))
+            self._insert_rows(name, documents)
+
+    def all(self, name: str) -> List[Document]:
+        with self._lock:
+            cursor = self._conn.execute('SELECT doc_id, data FROM projz_documents WHERE tbl=? ORDER BY doc_id',
+                                        (name,))
+            docs = [Document(json.loads(data), doc_id) for doc_id, data in cursor]
+            doc_map = dict()
+            for d in docs:
+                d['block'] = []
+                doc_map[d.doc_id] = d
+            cursor = self._conn.execute('SELECT doc_id, data FROM projz_blocks WHERE tbl=? '
+                                        'ORDER BY doc_id, block_idx', (name,))
+            for doc_id, data in cursor:
+                d = doc_map.get(doc_id, None)
+                if d is not None:
+                    d['block'].append(json.loads(data))
+            return docs
+
+    def get(self, name: str, doc_id: int):
+        with self._lock:
+            row = self._conn.execute('SELECT doc_id, data FROM projz_documents WHERE tbl=? AND doc_id=?',
+                                     (name, doc_id)).fetchone()
+            return self._to_document(name, row)
+
+    def get_by_identifier(self, name: str, identifier: str):
+        with self._lock:
+            row = self._conn.execute('SELECT doc_id, data FROM projz_documents WHERE tbl=? AND identifier=? '
+                                     'ORDER BY doc_id LIMIT 1', (name, identifier)).fetchone()
+            return self._to_document(name, row)
+
+    def get_blocks(self, name: str, keys: Iterable[Tuple[int, int]]):
+        """
+        Get blocks by their (doc_id, block_idx).
+
+        :return: A dict mapping each found (doc_id, block_idx) to its block
+        """
+        res = dict()
+        with self._lock:
+            for doc_id, block_idx in keys:
+                row = self._conn.execute('SELECT data FROM projz_blocks WHERE tbl=? AND doc_id=? AND block_idx=?',
+                                         (name, doc_id, block_idx)).fetchone()
+                if row is not None:
+                    res[(doc_id, block_idx)] = json.loads(row[0])
+        return res
+
+    def update_blocks(self, name: str, updates: Iterable[Tuple[int, int, Mapping]]) -> int:
+        """
+        Replace blocks by their (doc_id, block_idx).
+
+        :return: The number of updated blocks
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.executemany('UPDATE projz_blocks SET data=? WHERE tbl=? AND doc_id=? AND block_idx=?',
+                                            [(_dumps(b), name, doc_id, block_idx)
+                                             for doc_id, block_idx, b in updates])
+            return cursor.rowcount
+
+    def update_multiple_by_id(self, name: str, updates: Iterable[Tuple[Mapping, int]]) -> List[int]:
+        updated_ids = []
+        with self._lock, self._conn:
+            for fields, doc_id in updates:
+                row = self._conn.execute('SELECT data FROM projz_documents WHERE tbl=? AND doc_id=?',
+                                         (name, doc_id)).fetchone()
+                if row is None:
+                    continue
+                data = json.loads(row[0])
+                data.update(fields)
+                blocks = data.pop('block', None)
+                self._conn.execute('UPDATE projz_documents SET identifier=?, data=? WHERE tbl=? AND doc_id=?',
+                                   (data.get('identifier', None), _dumps(data), name, doc_id))
+                if blocks is not None:
+                    self._conn.execute('DELETE FROM projz_blocks WHERE tbl=? AND doc_id=?', (name, doc_id))
+                    self._conn.executemany('INSERT INTO projz_blocks(tbl, doc_id, block_idx, data) VALUES (?,?,?,?)',
+                                           [(name, doc_id, i, _dumps(b)) for i, b in enumerate(blocks)])
+                updated_ids.append(doc_id)
+        return updated_ids
+
+    def flush(self):
+        with self._lock:
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            try:
+                self._conn.commit()
+            finally:
+                self._conn.close()
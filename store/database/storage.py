@@ -0,0 +1,205 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+import logging
+import os
+import re
+from typing import Dict, Any, Optional, Tuple
+
+from tinydb import Storage
+from tinydb.storages import touch
+
+MANIFEST_SUFFIX = '.manifest'
+_WHITESPACES = re.compile(r'\s*')
+
+
+class _Unloaded:
+    """
+    A table whose data is still in the db file, at bytes [start, end).
+    """
+    __slots__ = ('start', 'end')
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+
+
+class LazyTables(dict):
+    """
+    Tables of a db, each of them is decoded on first access.
+    """
+
+    def __init__(self, storage: 'LazyJSONStorage', tables: Dict[str, Any]):
+        super().__init__(tables)
+        self._storage = storage
+
+    def __getitem__(self, name: str):
+        value = super().__getitem__(name)
+        if isinstance(value, _Unloaded):
+            value = self._storage.load_table(name, value)
+            super().__setitem__(name, value)
+        return value
+
+    def get(self, name: str, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def raw_items(self):
+        return super().items()
+
+
+class LazyJSONStorage(Storage):
+    """
+    A JSON storage compatible with the JSONStorage of TinyDB, which decodes a table only when it is accessed.
+    When writing the db file, byte offsets of each table are saved to a manifest file ({db_file}.manifest),
+    so tables can be listed and loaded without decoding the whole db file next time.
+    Tables which are never accessed are copied into the new db file as they are.
+    """
+
+    def __init__(self, path: str, create_dirs=False, encoding=None, **kwargs):
+        super().__init__()
+        touch(path, create_dirs=create_dirs)
+        self.path = path
+        self.manifest_file = path + MANIFEST_SUFFIX
+        self.encoding = encoding if encoding is not None else 'utf-8'
+        self.kwargs = kwargs
+        self._handle = open(path, 'rb')
+
+    def _stat(self):
+        st = os.stat(self.path)
+        return st.st_size, st.st_mtime_ns
+
+    def _read_manifest(self) -> Optional[Dict[str, Tuple[int, int]]]:
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # the manifest is out of date if the db file is modified by others
+        if [manifest.get('size', None), manifest.get('mtime_ns', None)] != list(self._stat()):
+            return None
+        return manifest['tables']
+
+    def _write_manifest(self, offsets: Dict[str, Tuple[int, int]]):
+        size, mtime_ns = self._stat()
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'size': size, 'mtime_ns': mtime_ns, 'tables': offsets}, f, ensure_ascii=False)
+        os.replace(tmp_file, self.manifest_file)
+
+    def load_table(self, name: str, unloaded: _Unloaded):
+        logging.debug(f'Load table {name} of {self.path}')
+        self._handle.seek(unloaded.start)
+        return json.loads(self._handle.read(unloaded.end - unloaded.start).decode(self.encoding))
+
+    def read(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        size, _ = self._stat()
+        if not size:
+            return None
+        offsets = self._read_manifest()
+        if offsets is not None:
+            return LazyTables(self, {k: _Unloaded(*v) for k, v in offsets.items()})
+        self._handle.seek(0)
+        data, offsets = self._decode_with_offsets(self._handle.read())
+        if offsets is not None:
+            # the db file is not modified, only its manifest is written, so it can be loaded lazily next time
+            self._write_manifest(offsets)
+        return LazyTables(self, data)
+
+    def _decode_with_offsets(self, raw: bytes):
+        """
+        Decode the db file, and find the byte offsets of each table in it.
+
+        :return: (tables, offsets), offsets is None if they can't be found
+        """
+        text = raw.decode(self.encoding)
+        try:
+            decoder = json.JSONDecoder()
+            tables, offsets = dict(), dict()
+            # offsets of chars are converted into offsets of bytes incrementally
+            char_pos, byte_pos = 0, 0
+
+            def _to_byte_pos(pos: int):
+                nonlocal char_pos, byte_pos
+                byte_pos += len(text[char_pos:pos].encode(self.encoding))
+                char_pos = pos
+                return byte_pos
+
+            def _skip(pos: int):
+                return _WHITESPACES.match(text, pos).end()
+
+            pos = _skip(0)
+            if text[pos] != '{':
+                return json.loads(text), None
+            pos = _skip(pos + 1)
+            while text[pos] != '}':
+                name, pos = decoder.raw_decode(text, pos)
+                pos = _skip(pos)
+                if text[pos] != ':':
+                    raise ValueError(f'Expecting \':\' at {pos}')
+                start = _skip(pos + 1)
+                tables[name], pos = decoder.raw_decode(text, start)
+                offsets[name] = (_to_byte_pos(start), _to_byte_pos(pos))
+                pos = _skip(pos)
+                if text[pos] == ',':
+                    pos = _skip(pos + 1)
+            return tables, offsets
+        except (ValueError, IndexError) as e:
+            logging.warning(f'Failed to find offsets of tables in {self.path}: {e}')
+            return json.loads(text), None
+
+    def write(self, data: Dict[str, Dict[str, Any]]):
+        raw_items = data.raw_items() if isinstance(data, LazyTables) else data.items()
+        offsets = dict()
+        tmp_file = self.path + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pos = f.write(b'{')
+            for i, (name, value) in enumerate(raw_items):
+                head = (', ' if i > 0 else '') + json.dumps(name, **self.kwargs) + ': '
+                pos += f.write(head.encode(self.encoding))
+                if isinstance(value, _Unloaded):
+                    # copy the table without decoding it
+                    self._handle.seek(value.start)
+                    serialized = self._handle.read(value.end - value.start)
+                else:
+                    serialized = json.dumps(value, **self.kwargs).encode(self.encoding)
+                offsets[name] = (pos, pos + len(serialized))
+                pos += f.write(serialized)
+            f.write(b'}')
+            f.flush()
+            os.fsync(f.fileno())
+        # some platforms cannot replace a file that is still open
+        self._handle.close()
+        try:
+            os.replace(tmp_file, self.path)
+        finally:
+            self._handle = open(self.path, 'rb')
+        self._write_manifest(offsets)
+        if isinstance(data, LazyTables):
+            # unloaded tables are at their new offsets now
+            for name, value in list(data.raw_items()):
+                if isinstance(value, _Unloaded):
+                    dict.__setitem__(data, name, _Unloaded(*offsets[name]))
+
+    def close(self) -> None:
+        self._handle.close()
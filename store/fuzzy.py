@@ -0,0 +1,230 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import re
+from difflib import SequenceMatcher
+from typing import List, Tuple, Optional, Iterable, Dict
+
+import numpy as np
+import tqdm
+
+from store.index import TranslationIndex
+from util.renpy import list_vars, list_tags
+
+_PRIME = (1 << 31) - 1
+_BASE = 1000003
+_WHITESPACES = re.compile(r'\s+')
+
+
+def _normalize(text: str) -> str:
+    return _WHITESPACES.sub(' ', text).strip().lower()
+
+
+class FuzzyMatch:
+    __slots__ = ('source', 'translation', 'score')
+
+    def __init__(self, source: str, translation: str, score: float):
+        self.source = source
+        self.translation = translation
+        self.score = score
+
+    def __repr__(self):
+        return f'FuzzyMatch({self.source!r}->{self.translation!r}, {self.score:.2f})'
+
+    def same_markup(self, text: str) -> bool:
+        """
+        Whether the source has the same [variables] and {tags} as the text, otherwise the translation
+        can't be used for the text as it is.
+        """
+        return list_vars(self.source) == list_vars(text) and list_tags(self.source) == list_tags(text)
+
+
+class FuzzyIndex:
+    """
+    An in-memory index of translated (source, translation) pairs, which finds the most similar source of a text.
+    Sources are indexed by MinHash signatures of their character n-grams with LSH (Locality-Sensitive Hashing)
+    buckets, so only a few candidates sharing a bucket with the text are compared by SequenceMatcher.ratio().
+    """
+
+    def __init__(self, ngram: int = 3, num_perm: int = 64, bands: int = 16, max_candidates: int = 5,
+                 max_bucket_scan: int = 32, seed: int = 1):
+        '''
+
+        :param ngram: The length of character n-grams
+        :param num_perm: The number of hash functions of MinHash
+        :param bands: The number of LSH bands, more bands find less similar candidates.
+            Each band has num_perm / bands rows, fewer rows make larger buckets
+        :param max_candidates: The max number of candidates compared with the text
+        :param max_bucket_scan: The max number of ids sampled from a bucket, so a bucket of common n-grams
+            does not slow down queries
+        '''
+        assert num_perm % bands == 0, f'num_perm({num_perm}) should be divisible by bands({bands})!'
+        self.ngram = ngram
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_candidates = max_candidates
+        self.max_bucket_scan = max_bucket_scan
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, _PRIME, size=(num_perm, 1)).astype(np.uint64)
+        self._b = rng.randint(0, _PRIME, size=(num_perm, 1)).astype(np.uint64)
+        # combine rows of a band into a bucket key
+        self._band_coef = rng.randint(1, _PRIME, size=self.rows).astype(np.uint64)
+        # bucket key -> an id, or a list of ids
+        self._buckets = [dict() for _ in range(bands)]
+        self._exact = dict()
+        self._sources: List[str] = []
+        self._translations: List[str] = []
+
+    def __len__(self):
+        return len(self._sources)
+
+    def _signatures(self, norm_texts: List[str]) -> np.ndarray:
+        """
+        MinHash signatures of non-empty texts, computed at once.
+
+        :return: An array of shape (len(norm_texts), num_perm)
+        """
+        codes_list = [np.frombuffer(t.encode('utf-32-le'), dtype=np.uint32) for t in norm_texts]
+        lengths = np.array([len(c) for c in codes_list], dtype=np.int64)
+        codes = np.concatenate(codes_list).astype(np.uint64)
+        # polynomial hashes of character n-grams starting at each position, a text shorter than n is one n-gram
+        n = self.ngram
+        hashes = np.zeros(len(codes), dtype=np.uint64)
+        for k in range(n):
+            shifted = np.zeros(len(codes), dtype=np.uint64)
+            shifted[:len(codes) - k] = codes[k:]
+            hashes = (hashes * _BASE + shifted) % _PRIME
+        # drop n-grams crossing the end of a text
+        counts = np.maximum(lengths - n + 1, 1)
+        starts = np.cumsum(lengths) - lengths
+        offsets = np.cumsum(counts) - counts
+        positions = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(offsets, counts)
+        hashes = hashes[positions]
+        short = np.repeat(lengths < n, counts)
+        if short.any():
+            # hashes of short texts: zeros shifted in after the text are also hashed
+            hashes[short] = [self._short_hash(c) for c, l in zip(codes_list, lengths) if l < n]
+        return np.minimum.reduceat((self._a * hashes + self._b) % _PRIME, offsets, axis=1).T
+
+    @staticmethod
+    def _short_hash(codes: np.ndarray) -> int:
+        h = 0
+        for c in codes.tolist():
+            h = (h * _BASE + c) % _PRIME
+        return h
+
+    def _band_keys(self, signature: np.ndarray):
+        # overflows of uint64 are fine for keys
+        return (signature.reshape(self.bands, self.rows) * self._band_coef).sum(axis=1).tolist()
+
+    def add(self, source: str, translation: str):
+        self.add_all([(source, translation)])
+
+    def add_all(self, pairs: Iterable[Tuple[str, str]], chunk_size: int = 1024):
+        chunk = []
+        for source, translation in pairs:
+            norm_text = _normalize(source)
+            if not norm_text or norm_text in self._exact:
+                continue
+            self._exact[norm_text] = len(self._sources)
+            self._sources.append(source)
+            self._translations.append(translation)
+            chunk.append(norm_text)
+            if len(chunk) >= chunk_size:
+                self._index_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._index_chunk(chunk)
+
+    def _index_chunk(self, norm_texts: List[str]):
+        first_idx = len(self._sources) - len(norm_texts)
+        for idx, signature in enumerate(self._signatures(norm_texts), first_idx):
+            for bucket, key in zip(self._buckets, self._band_keys(signature)):
+                ids = bucket.get(key, None)
+                if ids is None:
+                    bucket[key] = idx
+                elif isinstance(ids, list):
+                    ids.append(idx)
+                else:
+                    bucket[key] = [ids, idx]
+
+    def _sample(self, ids: List[int], band: int) -> List[int]:
+        n = len(ids)
+        if n <= self.max_bucket_scan:
+            return ids
+        # a stable sample spread over the bucket, starting at a different position in each band,
+        # so lines added later are scanned as well as those added first
+        step = n / self.max_bucket_scan
+        offset = step * band / self.bands
+        return [ids[int(offset + k * step)] for k in range(self.max_bucket_scan)]
+
+    def _scan(self, norm_text: str) -> Dict[int, int]:
+        """
+        Scan buckets of the text, at most bands * max_bucket_scan ids are scanned.
+
+        :return: {id of source: the number of bands it shares with the text}
+        """
+        counts = dict()
+        for band, (bucket, key) in enumerate(zip(self._buckets, self._band_keys(self._signatures([norm_text])[0]))):
+            ids = bucket.get(key, None)
+            if ids is None:
+                continue
+            for i in (self._sample(ids, band) if isinstance(ids, list) else (ids,)):
+                counts[i] = counts.get(i, 0) + 1
+        return counts
+
+    def query(self, text: str, threshold: float = 0.) -> Optional[FuzzyMatch]:
+        """
+        Find the most similar source of the text.
+
+        :param threshold: The min similarity (0~1) of a match
+        :return: None if no source with a similarity not less than the threshold
+        """
+        norm_text = _normalize(text)
+        if not norm_text:
+            return None
+        idx = self._exact.get(norm_text, None)
+        if idx is not None:
+            return FuzzyMatch(self._sources[idx], self._translations[idx], 1.)
+        counts = self._scan(norm_text)
+        # candidates sharing more bands are more similar
+        candidates = sorted(counts.keys(), key=lambda k: counts[k], reverse=True)[:self.max_candidates]
+        best, best_score = None, threshold
+        for i in candidates:
+            matcher = SequenceMatcher(None, norm_text, _normalize(self._sources[i]), autojunk=False)
+            if matcher.real_quick_ratio() < best_score or matcher.quick_ratio() < best_score:
+                continue
+            score = matcher.ratio()
+            if score >= best_score:
+                best, best_score = i, score
+        if best is None:
+            return None
+        return FuzzyMatch(self._sources[best], self._translations[best], best_score)
+
+    @classmethod
+    def from_indexes(cls, lang: str, indexes: List[TranslationIndex] = None, **kwargs):
+        """
+        Build a FuzzyIndex from translations of the language in TranslationIndexes.
+
+        :param indexes: TranslationIndexes to use, default to all TranslationIndexes
+        """
+        if indexes is None:
+            indexes = [i for _, i in TranslationIndex.list_indexes()]
+        fuzzy_index = cls(**kwargs)
+        for index in tqdm.tqdm(indexes, desc='Building the fuzzy translation memory'):
+            if index.exists_lang(lang):
+                fuzzy_index.add_all(index.get_translation_pairs(lang))
+        print(f'{len(fuzzy_index)} translations are in the fuzzy translation memory of {lang}.')
+        return fuzzy_index
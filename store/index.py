@@ -13,20 +13,24 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-import glob
 import os.path
 import random
+import threading
 import uuid
 from collections import defaultdict
 from typing import Tuple, List
 
 import regex
+import tqdm
 
 from config import default_config
 from injection import Project, get_translations, generate_translations, count_translations
 from store import index_type
 from store.database import TranslationIndexDao, TranslationDao
-from store.database.base import db_context
+from store.database.base import db_context, in_db_context, on_context_exit
+from store.database.impl import migrate_to_sqlite, remove_sidecar_files
+from store.database.sqlite import engine_of, SQLITE_ENGINE
+from store.unit import BlockRecord, TranslationRecord
 from util import exists_dir, strip_or_none, assert_not_blank, exists_file, to_translatable_text, to_string_text
 from util.renpy import list_tags
 
@@ -42,10 +46,31 @@ def extra_data_of(itype: int, data: dict = None):
     return data
 
 
+class _TranslationCache:
+    """
+    Decoded translations of a language, with blocks mapped by their (doc_id, block_idx) which is what a tid encodes.
+    """
+
+    def __init__(self, dialogue_data: list, string_data: list):
+        self.dialogue_data = dialogue_data
+        self.string_data = string_data
+        self.dblock_map = {(v.doc_id, i): b for v in dialogue_data for i, b in enumerate(v['block'])}
+        self.sblock_map = {(v.doc_id, i): b for v in string_data for i, b in enumerate(v['block'])}
+
+
 class TranslationIndex:
     DIALOGUE_ID_PREFIX = 'D'
     STRING_ID_PREFIX = 'S'
     TID_PATTERN = regex.compile(r'^([DS])(\d+)_(\d+)$')
+    # Translations decoded in a db_context: {db_file: {lang: _TranslationCache}}.
+    # Blocks are updated in place when writing, and all of them are dropped when the db_context exits.
+    _CACHE = dict()
+    _CACHE_LOCK = threading.Lock()
+    # Languages whose stats are marked dirty by this process: {(db_file, lang)}.
+    # Stats are saved in index.db, which is flushed separately from the db of translations. So the stats of a
+    # language are marked dirty in index.db before its translations are written, and a dirty mark which is not
+    # made by this process is left by a crashed run, whose stats may miss some written translations.
+    _DIRTY_MARKS = set()
 
     def __init__(self, project: Project, nickname: str, tag: str, stats: dict = None, db_file: str = None,
                  extra_data: dict = None, doc_id: int = None):
@@ -161,7 +186,27 @@ class TranslationIndex:
         return TranslationIndex.DIALOGUE_ID_PREFIX + lang, TranslationIndex.STRING_ID_PREFIX + lang
 
     def _open_db(self):
-        return TranslationDao(self._db_file)
+        return TranslationDao.open(self._db_file)
+
+    @property
+    def db_engine(self):
+        return engine_of(self._db_file, default_config.db_engine)
+
+    @db_context
+    def migrate_db(self):
+        """
+        Convert the TinyDB db file of this TranslationIndex into the SQLite format.
+        The original file is kept as {db_file}.bak.
+        """
+        if not exists_file(self._db_file):
+            print(f'{self._db_file} not found!')
+            return
+        if self.db_engine == SQLITE_ENGINE:
+            print(f'{self._db_file} is already in the SQLite format.')
+            return
+        n_docs = migrate_to_sqlite(self._db_file)
+        print(f'{n_docs} documents are migrated into the SQLite db: {self._db_file}, '
+              f'and the original file is saved to {self._db_file}.bak')
 
     @db_context
     def update_translation_stats(self, lang: str = None, say_only=True):
@@ -190,6 +235,10 @@ class TranslationIndex:
                         untrans_cnt += 1
             return trans_cnt, untrans_cnt
 
+        modes = self._stats.get('say_only', dict())
+        # recounted stats are not dirty, except those of translations written by this process but not durable yet
+        dirty = [l for l in self._stats.get('dirty', []) if (self._db_file, l) in self._DIRTY_MARKS
+                 or (strip_or_none(lang) is not None and l != strip_or_none(lang))]
         with self._open_db() as dao:
             lang = strip_or_none(lang)
             if lang is not None:
@@ -201,21 +250,119 @@ class TranslationIndex:
                     print(f'The language {lang} is not found!')
                     return
             else:
+                modes = dict()
                 langs = dao.list_langs()
+            # only load translations into the cache when recounting a single language
+            create_cache = lang is not None
+
+            def list_by(table_name: str, prefix: str):
+                cache = self._get_cache(table_name[len(prefix):], create=create_cache)
+                if cache is None:
+                    return dao.list_by_lang(table_name)
+                return cache.dialogue_data if prefix == self.DIALOGUE_ID_PREFIX else cache.string_data
+
             for lang in langs:
                 if lang.startswith(self.DIALOGUE_ID_PREFIX):
-                    dialogue_stats[lang[len(self.DIALOGUE_ID_PREFIX):]] = count_dialogue(dao.list_by_lang(lang))
+                    dialogue_stats[lang[len(self.DIALOGUE_ID_PREFIX):]] = count_dialogue(list_by(lang, self.DIALOGUE_ID_PREFIX))
+                    # record the mode for updating stats incrementally
+                    modes[lang[len(self.DIALOGUE_ID_PREFIX):]] = say_only
                 elif lang.startswith(self.STRING_ID_PREFIX):
-                    strings_stats[lang[len(self.STRING_ID_PREFIX):]] = count_string(dao.list_by_lang(lang))
+                    strings_stats[lang[len(self.STRING_ID_PREFIX):]] = count_string(list_by(lang, self.STRING_ID_PREFIX))
+                    # a language may have strings only
+                    modes.setdefault(lang[len(self.STRING_ID_PREFIX):], say_only)
                 else:
                     # who saves the undefined lang?
                     pass
         new_stats = {
             'dialogue': dialogue_stats,
             'string': strings_stats,
+            'say_only': modes,
+            'dirty': dirty,
         }
+        self._stats = new_stats
         self._update({'stats': new_stats})
 
+    def _update_translation_stats_by(self, lang: str, dialogue_changes: List[Tuple[dict, str]],
+                                     string_changes: List[Tuple[dict, str]], say_only=True):
+        """
+        Update translation stats with the changes of updated blocks instead of recounting all of them.
+        It falls back to update_translation_stats() if the stats of this language have not been counted yet.
+
+        :param lang: language
+        :param dialogue_changes: List[(updated dialogue block, its new_code before updating)]
+        :param string_changes: List[(updated string block, its new_code before updating)]
+        :param say_only: say_only for recounting
+        :return:
+        """
+        dstats = self._stats['dialogue'].get(lang, None)
+        sstats = self._stats['string'].get(lang, None)
+        mode = self._stats.get('say_only', dict()).get(lang, None)
+        # a language may have no dialogue or no string table, whose stats are not counted
+        if mode is None or (dstats is None and dialogue_changes) or (sstats is None and string_changes):
+            self._clear_stats_dirty(lang)
+            self.update_translation_stats(lang, say_only=say_only)
+            return
+
+        def _apply(stats, changes, is_dialogue):
+            trans_cnt, untrans_cnt = stats[0], stats[1]
+            for b, old_code in changes:
+                if is_dialogue and not self._is_say_block(b) and mode:
+                    continue
+                delta = (b['new_code'] is not None) - (old_code is not None)
+                trans_cnt += delta
+                untrans_cnt -= delta
+            return trans_cnt, untrans_cnt
+
+        if dstats is not None:
+            self._stats['dialogue'][lang] = _apply(dstats, dialogue_changes, True)
+        if sstats is not None:
+            self._stats['string'][lang] = _apply(sstats, string_changes, False)
+        self._clear_stats_dirty(lang)
+        self._update({'stats': self._stats})
+
+    def _recount_stale_stats(self, lang: str, say_only=True):
+        """
+        Recount the stats of the language if they are marked dirty by a crashed run.
+        It must be called before any block of the language is changed.
+        """
+        if lang in self._stats.get('dirty', []) and (self._db_file, lang) not in self._DIRTY_MARKS:
+            print(f'Translation stats of {lang} may be out of date, recounting them...')
+            self.update_translation_stats(lang, say_only=self._stats.get('say_only', dict()).get(lang, say_only))
+
+    def _mark_stats_dirty(self, lang: str):
+        """
+        Mark the stats of the language dirty in index.db before writing its translations.
+        """
+        if (self._db_file, lang) in self._DIRTY_MARKS:
+            return
+        dirty = self._stats.setdefault('dirty', [])
+        if lang not in dirty:
+            dirty.append(lang)
+        self._DIRTY_MARKS.add((self._db_file, lang))
+        self._update({'stats': self._stats})
+        with TranslationIndexDao() as dao:
+            dao.flush()
+
+    def _move_stats_dirty(self, lang: str, target_name: str, copy: bool):
+        dirty = self._stats.get('dirty', [])
+        if lang in dirty and target_name not in dirty:
+            dirty.append(target_name)
+            if (self._db_file, lang) in self._DIRTY_MARKS:
+                self._DIRTY_MARKS.add((self._db_file, target_name))
+        if not copy:
+            self._clear_stats_dirty(lang, force=True)
+
+    def _clear_stats_dirty(self, lang: str, force: bool = False):
+        # the mark is kept until the next recount if written translations may be lost in a crash
+        if not force:
+            with self._open_db() as dao:
+                if not dao.durable_writes():
+                    return
+        self._DIRTY_MARKS.discard((self._db_file, lang))
+        dirty = self._stats.get('dirty', [])
+        if lang in dirty:
+            dirty.remove(lang)
+
     def exists_lang(self, lang):
         lang = strip_or_none(lang)
         if lang is not None:
@@ -231,6 +378,7 @@ class TranslationIndex:
         if lang is None:
             return
         dlang, slang = self._get_table_name(lang)
+        self._invalidate_cache(lang)
         with self._open_db() as dao:
             dao.delete_by_lang(dlang)
             dao.delete_by_lang(slang)
@@ -239,19 +387,54 @@ class TranslationIndex:
                 self._stats['dialogue'].pop(lang)
             if lang in self._stats['string']:
                 self._stats['string'].pop(lang)
+            self._stats.get('say_only', dict()).pop(lang, None)
+            self._clear_stats_dirty(lang, force=True)
             self._update({'stats': self._stats})
 
+    def _get_cache(self, lang: str, create: bool = True):
+        """
+        Get the cached translations of a language, which only live in a db_context.
+
+        :param lang: language
+        :param create: Load translations of the language if they are not cached
+        :return: A _TranslationCache, or None if not in a db_context or the language is not found
+        """
+        if not in_db_context():
+            return None
+        with self._CACHE_LOCK:
+            caches = self._CACHE.setdefault(self._db_file, dict())
+            cache = caches.get(lang, None)
+            if cache is None and create:
+                dialogue_data, string_data = self._load_translations(lang)
+                if dialogue_data or string_data:
+                    cache = _TranslationCache(dialogue_data, string_data)
+                    caches[lang] = cache
+            return cache
+
+    def _invalidate_cache(self, *langs: str):
+        caches = self._CACHE.get(self._db_file, None)
+        if caches:
+            for lang in langs:
+                caches.pop(lang, None)
+
     def _list_translations(self, lang: str):
         lang = strip_or_none(lang)
         if lang is None:
             return [], []
+        cache = self._get_cache(lang)
+        if cache is not None:
+            return cache.dialogue_data, cache.string_data
+        return self._load_translations(lang)
+
+    def _load_translations(self, lang: str):
         with self._open_db() as dao:
             langs = dao.list_langs()
             dlang, slang = self._get_table_name(lang)
             if dlang not in langs and slang not in langs:
                 return [], []
-            dialogue_data = dao.list_by_lang(dlang)
-            string_data = dao.list_by_lang(slang)
+            # use compact records instead of the dicts read from db
+            dialogue_data = [TranslationRecord.from_dict(d) for d in dao.list_by_lang(dlang)]
+            string_data = [TranslationRecord.from_dict(d) for d in dao.list_by_lang(slang)]
         return dialogue_data, string_data
 
     def get_translated_lines(self, lang: str, say_only=True, source_code=False, not_modify: bool = False):
@@ -301,6 +484,25 @@ class TranslationIndex:
                                 _strip_fn(to_translatable_text(b['new_code']))])
         return res
 
+    def get_translation_pairs(self, lang: str) -> List[Tuple[str, str]]:
+        """
+        Return (source text, translated text) pairs of translated dialogues (say statements only) and strings
+        """
+        res = []
+        lang = strip_or_none(lang)
+        if lang is None:
+            return res
+        dialogue_data, string_data = self._list_translations(lang)
+        for v in dialogue_data:
+            for b in v['block']:
+                if b['new_code'] is not None and b['what'] is not None and self._is_say_block(b):
+                    res.append((to_translatable_text(b['what']), to_translatable_text(b['new_code'])))
+        for v in string_data:
+            for b in v['block']:
+                if b['new_code'] is not None and b['what'] is not None:
+                    res.append((to_translatable_text(b['what']), to_translatable_text(b['new_code'])))
+        return res
+
     @db_context
     def rename_lang(self, lang: str, target_name: str):
         lang = assert_not_blank(lang, 'lang')
@@ -311,20 +513,15 @@ class TranslationIndex:
         if self.exists_lang(new_lang):
             print(f'The language {target_name} already exists!')
             return
-        dialogue_data, string_data = self._list_translations(lang)
-        for v in dialogue_data:
-            v['language'] = new_lang
-        for v in string_data:
-            v['language'] = new_lang
         dlang, slang = self._get_table_name(lang)
         tdlang, tslang = self._get_table_name(target_name)
+        self._invalidate_cache(lang, new_lang)
         with self._open_db() as dao:
             dao.delete_by_lang(tdlang)
             dao.delete_by_lang(tslang)
-            dao.add_batch(tdlang, dialogue_data)
-            dao.add_batch(tslang, string_data)
-            dao.delete_by_lang(dlang)
-            dao.delete_by_lang(slang)
+            # move tables in the db instead of reloading them
+            dao.rename_table(dlang, tdlang, {'language': new_lang})
+            dao.rename_table(slang, tslang, {'language': new_lang})
             # update translation stats
             if lang in self._stats['dialogue']:
                 old_stats = self._stats['dialogue'].pop(lang)
@@ -332,6 +529,10 @@ class TranslationIndex:
             if lang in self._stats['string']:
                 old_stats = self._stats['string'].pop(lang)
                 self._stats['string'][target_name] = old_stats
+            modes = self._stats.get('say_only', dict())
+            if lang in modes:
+                modes[target_name] = modes.pop(lang)
+            self._move_stats_dirty(lang, target_name, copy=False)
             self._update({'stats': self._stats})
 
     def get_untranslated_lines(self, lang: str, say_only=True, source_code=False, not_modify: bool = False):
@@ -385,6 +586,7 @@ class TranslationIndex:
         lang = strip_or_none(lang)
         if lang is None:
             return
+        self._recount_stale_stats(lang, say_only=say_only)
         dialogue_data, string_data = self._list_translations(lang)
         if len(dialogue_data) == 0 and len(string_data) == 0:
             print(f'No translations of language {lang}')
@@ -395,6 +597,7 @@ class TranslationIndex:
         sdocid_map = dict()
         updated_ddocids = set()
         updated_sdocids = set()
+        dchanges, schanges = [], []
         for v in dialogue_data:
             ddocid_map[v.doc_id] = v['block']
             for i, b in enumerate(v['block']):
@@ -407,6 +610,7 @@ class TranslationIndex:
                 else:
                     b['new_code'] = b['code']
                 updated_ddocids.add(v.doc_id)
+                dchanges.append((b, None))
         for v in string_data:
             sdocid_map[v.doc_id] = v['block']
             for i, b in enumerate(v['block']):
@@ -414,18 +618,20 @@ class TranslationIndex:
                     continue
                 b['new_code'] = b['what']
                 updated_sdocids.add(v.doc_id)
+                schanges.append((b, None))
 
         if len(updated_ddocids) == 0 and len(updated_sdocids) == 0:
             print(f'No untranslated lines of language {lang} to be updated')
             return
 
         # write updated translations to db
+        self._mark_stats_dirty(lang)
         dlang, slang = self._get_table_name(lang)
         self._update_batch(dlang, updated_ddocids, ddocid_map)
         self._update_batch(slang, updated_sdocids, sdocid_map)
         # update statistics when updating translation
         if updated_ddocids or updated_sdocids:
-            self.update_translation_stats(lang, say_only=say_only)
+            self._update_translation_stats_by(lang, dchanges, schanges, say_only=say_only)
         print(f'{lang}: {len(updated_ddocids)} updated dialogue translations, '
               f'{len(updated_sdocids)} updated string translations.')
 
@@ -434,6 +640,7 @@ class TranslationIndex:
         lang = strip_or_none(lang)
         if lang is None:
             return
+        self._recount_stale_stats(lang, say_only=say_only)
         dialogue_data, string_data = self._list_translations(lang)
         if len(dialogue_data) == 0 and len(string_data) == 0:
             print(f'No translations of language {lang}')
@@ -444,6 +651,7 @@ class TranslationIndex:
         sdocid_map = dict()
         updated_ddocids = set()
         updated_sdocids = set()
+        dchanges, schanges = [], []
         for v in dialogue_data:
             ddocid_map[v.doc_id] = v['block']
             for i, b in enumerate(v['block']):
@@ -451,6 +659,7 @@ class TranslationIndex:
                     continue
                 if not self._is_say_block(b) and say_only:
                     continue
+                dchanges.append((b, b['new_code']))
                 b['new_code'] = None
                 updated_ddocids.add(v.doc_id)
         for v in string_data:
@@ -458,6 +667,7 @@ class TranslationIndex:
             for i, b in enumerate(v['block']):
                 if b['new_code'] is None:
                     continue
+                schanges.append((b, b['new_code']))
                 b['new_code'] = None
                 updated_sdocids.add(v.doc_id)
 
@@ -466,12 +676,13 @@ class TranslationIndex:
             return
 
         # write updated translations to db
+        self._mark_stats_dirty(lang)
         dlang, slang = self._get_table_name(lang)
         self._update_batch(dlang, updated_ddocids, ddocid_map)
         self._update_batch(slang, updated_sdocids, sdocid_map)
         # update statistics when updating translation
         if updated_ddocids or updated_sdocids:
-            self.update_translation_stats(lang, say_only=say_only)
+            self._update_translation_stats_by(lang, dchanges, schanges, say_only=say_only)
         print(f'{lang}: {len(updated_ddocids)} updated dialogue translations, '
               f'{len(updated_sdocids)} updated string translations.')
 
@@ -484,24 +695,37 @@ class TranslationIndex:
         if self.exists_lang(new_lang):
             print(f'The language {target_name} already exists!')
             return
-        dialogue_data, string_data = self._list_translations(lang)
-        for v in dialogue_data:
-            v['language'] = new_lang
-        for v in string_data:
-            v['language'] = new_lang
+        dlang, slang = self._get_table_name(lang)
         tdlang, tslang = self._get_table_name(target_name)
+        self._invalidate_cache(new_lang)
         with self._open_db() as dao:
-            dao.add_batch(tdlang, dialogue_data)
-            dao.add_batch(tslang, string_data)
+            # copy tables in the db instead of reloading them, doc_ids (and tids) are kept
+            dao.copy_table(dlang, tdlang, {'language': new_lang})
+            dao.copy_table(slang, tslang, {'language': new_lang})
             # update translation stats
             if lang in self._stats['dialogue']:
-                self._stats['dialogue'][target_name] = self._stats['dialogue'][lang].copy()
+                self._stats['dialogue'][target_name] = tuple(self._stats['dialogue'][lang])
             if lang in self._stats['string']:
-                self._stats['string'][target_name] = self._stats['string'][lang].copy()
+                self._stats['string'][target_name] = tuple(self._stats['string'][lang])
+            modes = self._stats.get('say_only', dict())
+            if lang in modes:
+                modes[target_name] = modes[lang]
+            self._move_stats_dirty(lang, target_name, copy=True)
             self._update({'stats': self._stats})
 
+    @classmethod
+    def _dialogue_join_key(cls, identifier: str, block_i: int, block):
+        # Say blocks are matched whatever their types are, while other blocks must have the same type
+        return identifier, block_i, 'Say' if cls._is_say_block(block) else block.get('type', None)
+
     @db_context
     def merge_translations_from(self, target_index: 'TranslationIndex', lang: str, say_only=True):
+        """
+        Merge translations of the given TranslationIndex into untranslated lines of this one.
+        Dialogue lines are joined on (identifier, block index, type), and string lines on their original texts.
+        Lines of the source are counted as matched (found in this TranslationIndex), conflicting
+        (found, but translated differently here, which are kept) or orphaned (not found).
+        """
         assert target_index is not None, f'target_index must not be None'
         assert target_index != self, 'Cannot merge from self'
         lang = assert_not_blank(lang, 'lang')
@@ -511,82 +735,88 @@ class TranslationIndex:
         if not target_index.exists_lang(lang):
             print(f'No translations of language {lang} in source TranslationIndex, please import it first')
             return
+        self._recount_stale_stats(lang, say_only=say_only)
         dialogue_data, string_data = self._list_translations(lang)
 
-        # get all untranslations first, mapped by identifier
-        id_dblock_map = dict()
-        id_sblock_map = dict()
+        # build hash tables of this TranslationIndex, the source one is streamed through them
+        dblock_map = dict()
+        sblock_map = dict()
         ddocid_map = dict()
         sdocid_map = dict()
+        n_untranslated = 0
         for v in dialogue_data:
             ddocid_map[v.doc_id] = v['block']
             for i, b in enumerate(v['block']):
-                if b['new_code'] is not None:
-                    continue
                 if not self._is_say_block(b) and say_only:
                     continue
-                id_dblock_map[(v['identifier'], i)] = (b, v.doc_id)
+                dblock_map.setdefault(self._dialogue_join_key(v['identifier'], i, b), (b, v.doc_id))
+                n_untranslated += b['new_code'] is None
         for v in string_data:
             sdocid_map[v.doc_id] = v['block']
-            for i, b in enumerate(v['block']):
-                if b['new_code'] is not None:
-                    continue
-                id_sblock_map[(v['identifier'], i)] = (b, v.doc_id)
+            for b in v['block']:
+                sblock_map.setdefault(b['what'], []).append((b, v.doc_id))
+                n_untranslated += b['new_code'] is None
 
-        if len(id_dblock_map) == 0 and len(id_sblock_map) == 0:
+        if n_untranslated == 0:
             print(f'No translations of language {lang} to be merged')
             return
         # record updated doc_id
         updated_ddocids = set()
         updated_sdocids = set()
+        # all updated blocks are untranslated ones before merging
+        dchanges, schanges = dict(), dict()
         use_cnt = 0
         find_cnt = 0
+        match_cnt, conflict_cnt, orphan_cnt = 0, 0, 0
 
-        def _update_dialogue(identifier, block_i, new_code, block_type):
-            nonlocal use_cnt
-            block, doc_id = id_dblock_map.get((identifier, block_i), (None, None))
-            if block and ((self._is_say_block(block) and self._is_say_block(block_type))
-                          or block_type == block.get('type', None)):
-                block['new_code'] = new_code
-                updated_ddocids.add(doc_id)
-                use_cnt += 1
-
-        def _update_string(identifier, block_i, new_code):
-            nonlocal use_cnt
-            block, doc_id = id_sblock_map.get((identifier, block_i), (None, None))
-            if block:
-                block['new_code'] = new_code
-                updated_sdocids.add(doc_id)
-                use_cnt += 1
+        def _merge(pairs, new_code, updated_docids, changes):
+            nonlocal use_cnt, match_cnt, conflict_cnt, orphan_cnt
+            if not pairs:
+                orphan_cnt += 1
+                return
+            match_cnt += 1
+            for block, doc_id in pairs:
+                if block['new_code'] is None or id(block) in changes:
+                    block['new_code'] = new_code
+                    updated_docids.add(doc_id)
+                    changes[id(block)] = block
+                    use_cnt += 1
+                elif block['new_code'] != new_code:
+                    conflict_cnt += 1
 
         # for each translation in source index
         source_dialogue_data, source_string_data = target_index._list_translations(lang)
-        for v in source_dialogue_data:
+        for v in tqdm.tqdm(source_dialogue_data, desc='Merging dialogues...'):
             for i, b in enumerate(v['block']):
-                if b['new_code'] is not None:
-                    find_cnt += 1
-                    if self._is_say_block(b):
-                        _update_dialogue(v['identifier'], i, b['new_code'], b['type'])
-                    else:
-                        # for non-Say statement, must match its type
-                        if not say_only:
-                            _update_dialogue(v['identifier'], i, b['new_code'], b['type'])
-        for v in source_string_data:
-            for i, b in enumerate(v['block']):
-                if b['new_code'] is not None:
-                    find_cnt += 1
-                    _update_string(v['identifier'], i, b['new_code'])
+                if b['new_code'] is None:
+                    continue
+                find_cnt += 1
+                # non-Say statements are skipped in say_only mode
+                if not self._is_say_block(b) and say_only:
+                    continue
+                pair = dblock_map.get(self._dialogue_join_key(v['identifier'], i, b), None)
+                _merge([pair] if pair else None, b['new_code'], updated_ddocids, dchanges)
+        for v in tqdm.tqdm(source_string_data, desc='Merging strings...'):
+            for b in v['block']:
+                if b['new_code'] is None:
+                    continue
+                find_cnt += 1
+                _merge(sblock_map.get(b['what'], None), b['new_code'], updated_sdocids, schanges)
 
         # write updated translations to db
+        self._mark_stats_dirty(lang)
         dlang, slang = self._get_table_name(lang)
         self._update_batch(dlang, updated_ddocids, ddocid_map)
         self._update_batch(slang, updated_sdocids, sdocid_map)
         # update statistics when updating translation
         if updated_ddocids or updated_sdocids:
-            self.update_translation_stats(lang, say_only=say_only)
+            self._update_translation_stats_by(lang, [(b, None) for b in dchanges.values()],
+                                              [(b, None) for b in schanges.values()], say_only=say_only)
         print(f'{lang}: {len(updated_ddocids)} updated dialogue translations, '
               f'{len(updated_sdocids)} updated string translations. '
               f'[use:{use_cnt}, discord:{find_cnt - use_cnt}, total:{find_cnt}]')
+        print(f'{lang}: {match_cnt} matched, {conflict_cnt} conflicting (kept as they are), '
+              f'{orphan_cnt} orphaned translations in the source TranslationIndex.')
 
     @db_context
     def update_translations(self, lang: str, translated_lines: List[Tuple[str, str]], untranslated_only=True,
@@ -610,53 +840,57 @@ class TranslationIndex:
         if not self.exists_lang(lang):
             print(f'No translations of language {lang}, please import it first')
             return
-        dialogue_data, string_data = self._list_translations(lang)
-
-        # get all untranslations first, mapped by tid
-        tid_dblock_map = dict()
-        tid_sblock_map = dict()
-        ddocid_map = dict()
-        sdocid_map = dict()
-        for v in dialogue_data:
-            ddocid_map[v.doc_id] = v['block']
-            for i, b in enumerate(v['block']):
-                if b['new_code'] is not None and untranslated_only:
-                    continue
-                if not self._is_say_block(b) and say_only:
-                    continue
-                tid_dblock_map[self._encode_tid(self.DIALOGUE_ID_PREFIX, i, v.doc_id)] = b
-        for v in string_data:
-            sdocid_map[v.doc_id] = v['block']
-            for i, b in enumerate(v['block']):
-                if b['new_code'] is not None and untranslated_only:
-                    continue
-                tid_sblock_map[self._encode_tid(self.STRING_ID_PREFIX, i, v.doc_id)] = b
+        self._recount_stale_stats(lang, say_only=say_only)
 
-        if len(tid_dblock_map) == 0 and len(tid_sblock_map) == 0:
-            print(f'No translations of language {lang} to be updated')
-            return
+        # only load blocks addressed by the given tids
+        dkeys, skeys = set(), set()
+        for tid, new_code in translated_lines:
+            p, block_idx, doc_id = self._decode_tid(tid)
+            if p == self.DIALOGUE_ID_PREFIX:
+                dkeys.add((doc_id, block_idx))
+            elif p == self.STRING_ID_PREFIX:
+                skeys.add((doc_id, block_idx))
+        dlang, slang = self._get_table_name(lang)
+        # blocks of cached translations are updated in place
+        cache = self._get_cache(lang, create=False)
+        if cache is not None:
+            dblock_map, sblock_map = cache.dblock_map, cache.sblock_map
+        else:
+            with self._open_db() as dao:
+                dblock_map = {k: BlockRecord.from_dict(b) for k, b in
+                              (dao.select_blocks(dlang, dkeys) if dkeys else dict()).items()}
+                sblock_map = {k: BlockRecord.from_dict(b) for k, b in
+                              (dao.select_blocks(slang, skeys) if skeys else dict()).items()}
+
+        def _selectable(block, is_dialogue):
+            if block['new_code'] is not None and untranslated_only:
+                return False
+            if is_dialogue and not self._is_say_block(block) and say_only:
+                return False
+            return True
 
-        # record updated doc_id
-        updated_ddocids = set()
-        updated_sdocids = set()
+        # record updated blocks
+        dupdates, supdates = dict(), dict()
+        old_codes = dict()
         updating_cnt = 0
         for tid, new_code in translated_lines:
             if tid is None or new_code is None:
                 continue
-            p, _, doc_id = self._decode_tid(tid)
+            p, block_idx, doc_id = self._decode_tid(tid)
             if p:
                 block = None
-                updated_docids = None
-                # doc_id = None
+                updates = None
                 if p == self.DIALOGUE_ID_PREFIX:
-                    block = tid_dblock_map.get(tid, None)
-                    updated_docids = updated_ddocids
+                    block = dblock_map.get((doc_id, block_idx), None)
+                    updates = dupdates
                 elif p == self.STRING_ID_PREFIX:
-                    block = tid_sblock_map.get(tid, None)
-                    updated_docids = updated_sdocids
-                if block:
+                    block = sblock_map.get((doc_id, block_idx), None)
+                    updates = supdates
+                if block and ((doc_id, block_idx) in updates or _selectable(block, updates is dupdates)):
                     if discord_blank and new_code.strip() == '':
                         continue
+                    if (p, doc_id, block_idx) not in old_codes:
+                        old_codes[(p, doc_id, block_idx)] = block['new_code']
                     if self._is_user_block(block):
                         if not source_code:
                             new_code = self._to_userblock_text(block, new_code)
@@ -664,15 +898,23 @@ class TranslationIndex:
                     else:
                         block['new_code'] = to_string_text(new_code)
                     updating_cnt += 1
-                    updated_docids.add(doc_id)
+                    updates[(doc_id, block_idx)] = block
 
         # write updated translation to db
-        dlang, slang = self._get_table_name(lang)
-        self._update_batch(dlang, updated_ddocids, ddocid_map)
-        self._update_batch(slang, updated_sdocids, sdocid_map)
+        if dupdates or supdates:
+            self._mark_stats_dirty(lang)
+        with self._open_db() as dao:
+            if dupdates:
+                dao.replace_blocks(dlang, [(k[0], k[1], b.to_dict()) for k, b in dupdates.items()])
+            if supdates:
+                dao.replace_blocks(slang, [(k[0], k[1], b.to_dict()) for k, b in supdates.items()])
+        updated_ddocids = {k[0] for k in dupdates.keys()}
+        updated_sdocids = {k[0] for k in supdates.keys()}
         # update statistics when updating translation
         if updated_ddocids or updated_sdocids:
-            self.update_translation_stats(lang, say_only=say_only)
+            self._update_translation_stats_by(
+                lang, [(b, old_codes[(self.DIALOGUE_ID_PREFIX,) + k]) for k, b in dupdates.items()],
+                [(b, old_codes[(self.STRING_ID_PREFIX,) + k]) for k, b in supdates.items()], say_only=say_only)
         print(f'{lang}: {len(updated_ddocids)} updated dialogue translations, '
               f'{len(updated_sdocids)} updated string translations. '
               f'[use:{updating_cnt}, discord:{len(translated_lines) - updating_cnt}, total:{len(translated_lines)}]')
@@ -682,7 +924,7 @@ class TranslationIndex:
             ids, blocks = [], []
             for did in updated_docids:
                 ids.append(did)
-                blocks.append(docid_map[did])
+                blocks.append([b.to_dict() for b in docid_map[did]])
             with self._open_db() as dao:
                 dao.update_blocks(table_name, ids, blocks)
 
@@ -730,13 +972,13 @@ class TranslationIndex:
                         if not say_only:
                             new_block.append(b)
             if new_block:
-                new_v = v.copy()
-                new_v['block'] = new_block
+                new_v = v.to_dict()
+                new_v['block'] = [b.to_dict() for b in new_block]
                 new_dialogue_data.append(new_v)
         for v in string_data:
             for i, b in enumerate(v['block']):
                 if b['new_code'] is not None:
-                    new_string_data.append(v)
+                    new_string_data.append(v.to_dict())
         if len(new_dialogue_data) == 0 and len(new_string_data) == 0:
             print(f'No {lang} translations in this TranslationIndex to export')
             if translated_only:
@@ -830,11 +1072,9 @@ class TranslationIndex:
         # check among current db files to make sure not to overwrite an existing one
         if check_dbfiles:
             current_name = f'projz_{nickname}_{tag}.db'
-            db_files = sorted(glob.glob(os.path.join(default_config.project_path, '*.db')))
-            for f in db_files:
-                assert os.path.basename(f) != current_name, (
-                    f'A file named "{current_name}" in {default_config.project_path} found. '
-                    f'Please reassign another value for nickname({nickname}) or tag({tag})')
+            assert not exists_file(os.path.join(default_config.project_path, current_name)), (
+                f'A file named "{current_name}" in {default_config.project_path} found. '
+                f'Please reassign another value for nickname({nickname}) or tag({tag})')
         # then check in the db
         with TranslationIndexDao() as dao:
             assert not dao.contains({'nickname': nickname, 'tag': tag}, exclude_docid), (
@@ -942,5 +1182,9 @@ class TranslationIndex:
                 db_file = p.get('db_file', None)
                 if db_file and exists_file(db_file):
                     os.remove(db_file)
+                    remove_sidecar_files(db_file)
                     print(f'{db_file} is deleted.')
         return True
+
+
+on_context_exit(TranslationIndex._CACHE.clear)
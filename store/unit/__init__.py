@@ -16,3 +16,4 @@
 
 from .item import BlockItem, TranslationItem
 from .i18n import TranslationDict
+from .record import BlockRecord, TranslationRecord
@@ -0,0 +1,156 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import sys
+from typing import Mapping, List
+
+
+def _intern(s):
+    return sys.intern(s) if isinstance(s, str) else s
+
+
+class _Record:
+    """
+    A compact record with a fixed set of fields, which can be read and updated like the dict it is created from.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key: str):
+        if key in self.__slots__:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        if key in self.__slots__:
+            setattr(self, key, value)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key: str):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def get(self, key: str, default=None):
+        if key in self.__slots__:
+            return getattr(self, key)
+        return default
+
+    def keys(self):
+        return self.__slots__
+
+    def values(self):
+        return [getattr(self, k) for k in self.__slots__]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.__slots__]
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.to_dict()})'
+
+
+class BlockRecord(_Record):
+    __slots__ = ('type', 'what', 'who', 'code', 'new_code', 'parsed')
+
+    def __init__(self, type=None, what=None, who=None, code=None, new_code=None, parsed=None):
+        self.type = _intern(type)
+        self.what = what
+        self.who = _intern(who)
+        self.code = code
+        self.new_code = new_code
+        self.parsed = parsed if parsed is not None else []
+
+    def to_dict(self):
+        return {
+            'type': self.type,
+            'what': self.what,
+            'who': self.who,
+            'code': self.code,
+            'new_code': self.new_code,
+            'parsed': self.parsed,
+        }
+
+    @classmethod
+    def from_dict(cls, obj_dict: Mapping):
+        return cls(
+            type=obj_dict.get('type', None),
+            what=obj_dict.get('what', None),
+            who=obj_dict.get('who', None),
+            code=obj_dict.get('code', None),
+            new_code=obj_dict.get('new_code', None),
+            parsed=obj_dict.get('parsed', None),
+        )
+
+
+class TranslationRecord(_Record):
+    """
+    A translation document with its blocks, doc_id is the id of the document in the db.
+    Filenames and languages are interned, so they are shared by all records of the same file.
+    """
+    __slots__ = ('identifier', 'language', 'filename', 'linenumber', 'block', 'doc_id')
+
+    def __init__(self, identifier=None, language=None, filename=None, linenumber=None,
+                 block: List[BlockRecord] = None, doc_id: int = None):
+        self.identifier = identifier
+        self.language = _intern(language)
+        self.filename = _intern(filename)
+        self.linenumber = linenumber
+        self.block = block if block is not None else []
+        self.doc_id = doc_id
+
+    def keys(self):
+        # doc_id is not a field of the document
+        return self.__slots__[:-1]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.keys()]
+
+    def to_dict(self):
+        return {
+            'identifier': self.identifier,
+            'language': self.language,
+            'filename': self.filename,
+            'linenumber': self.linenumber,
+            'block': [b.to_dict() for b in self.block],
+        }
+
+    @classmethod
+    def from_dict(cls, obj_dict: Mapping, doc_id: int = None):
+        """
+        Create a record from a dict, or a Document read from a db whose doc_id is used if doc_id is not given.
+        """
+        if doc_id is None:
+            doc_id = getattr(obj_dict, 'doc_id', None)
+        return cls(
+            identifier=obj_dict.get('identifier', None),
+            language=obj_dict.get('language', None),
+            filename=obj_dict.get('filename', None),
+            linenumber=obj_dict.get('linenumber', None),
+            block=[BlockRecord.from_dict(b) for b in obj_dict.get('block', [])],
+            doc_id=doc_id,
+        )
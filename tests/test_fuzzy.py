@@ -0,0 +1,96 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import random
+import string
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from store.fuzzy import FuzzyIndex
+
+
+def _random_lines(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    # a small vocabulary with common words, like dialogues of a game
+    words = ['the', 'you', 'I', 'a', 'to', 'is', 'it', 'and', 'of', 'that'] + \
+            [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 8))) for _ in range(3000)]
+    weights = [200] * 10 + [1] * 3000
+    return [' '.join(rng.choices(words, weights, k=rng.randint(3, 15))) for _ in range(n)]
+
+
+def test_query_finds_similar_lines():
+    index = FuzzyIndex()
+    index.add_all([('Hello, how are you today?', '你好，你今天怎么样？'), ('See you tomorrow.', '明天见。')])
+    match = index.query('Hello, how are you today!', 0.9)
+    assert match is not None and match.translation == '你好，你今天怎么样？'
+    assert index.query('Something totally different', 0.9) is None
+
+
+def test_same_markup():
+    index = FuzzyIndex()
+    index.add('See you tomorrow, [mc].', '明天见，[mc]。')
+    match = index.query('See you tomorrow, [player].', 0.8)
+    assert match is not None and not match.same_markup('See you tomorrow, [player].')
+    match = index.query('see you tomorrow, [mc].', 0.8)
+    assert match is not None and match.same_markup('see you tomorrow, [mc].')
+
+
+def _similar_lines(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    # lines sharing a long prefix, so most of their LSH buckets are large
+    words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 6))) for _ in range(2000)]
+    lines = [f'Hello there, how are you doing today, my dear friend {rng.choice(words)} {rng.choice(words)}'
+             for _ in range(n)]
+    return list(dict.fromkeys(lines))
+
+
+def _n_found(index: FuzzyIndex, lines, threshold: float):
+    matches = [index.query(line + '?', threshold) for line in lines]
+    return sum(1 for m, line in zip(matches, lines) if m is not None and m.source == line)
+
+
+def test_scan_is_bounded():
+    lines = _random_lines(20000)
+    index = FuzzyIndex()
+    index.add_all((line, line.upper()) for line in lines)
+    for line in lines[:200]:
+        assert sum(index._scan(line).values()) <= index.bands * index.max_bucket_scan
+    assert _n_found(index, lines[:1000], 0.9) >= 950
+
+
+def test_lines_added_later_are_found_in_large_buckets():
+    lines = _similar_lines(20000)
+    index = FuzzyIndex()
+    index.add_all((line, line.upper()) for line in lines)
+    assert max(len(ids) for bucket in index._buckets for ids in bucket.values() if isinstance(ids, list)) > 10000
+    assert _n_found(index, lines[-1000:], 0.95) >= 900
+
+
+@pytest.mark.skipif(not os.environ.get('PROJZ_BENCHMARK', None), reason='set PROJZ_BENCHMARK=1 to run benchmarks')
+def test_query_latency():
+    n_lines, n_queries = 100000, 2000
+    lines = _random_lines(n_lines)
+    index = FuzzyIndex()
+    index.add_all((line, line.upper()) for line in lines)
+    st_time = time.perf_counter()
+    n_found = _n_found(index, lines[:n_queries], 0.9)
+    elapsed = (time.perf_counter() - st_time) / n_queries
+    assert elapsed < 1e-3, f'{elapsed * 1000:.3f}ms per query on {n_lines} lines'
+    assert n_found >= 0.95 * n_queries
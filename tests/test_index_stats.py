@@ -0,0 +1,83 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import default_config
+from injection import Project
+from store import TranslationIndex
+from store.database import base
+from store.misc import ast_of, block_of
+
+
+@pytest.fixture(params=['tinydb', 'sqlite'])
+def db_engine(request, monkeypatch):
+    monkeypatch.setattr(type(default_config), 'db_engine', property(lambda self: request.param))
+    return request.param
+
+
+def test_strings_only_lang_updates_stats_incrementally(tmp_path, monkeypatch, db_engine):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('projz/tmp')
+    index = TranslationIndex(Project(str(tmp_path / 'game'), 'x', 'strings_only'), 'strings_only', 'sqlite')
+    index.save()
+    with index._open_db() as dao:
+        dlang, slang = index._get_table_name('en')
+        dao.add_batch(slang, [ast_of(identifier=f's{i}', language='en', filename='a.rpy', linenumber=i,
+                                     block=[block_of(type='String', what=f'hi {i}', new_code=None)])
+                              for i in range(10)])
+    # recount all languages, only the string table of en is found
+    index.update_translation_stats()
+    assert index._stats['string']['en'] == (0, 10)
+    assert 'en' not in index._stats['dialogue']
+
+    def _recount(*args, **kwargs):
+        raise AssertionError('stats of a strings-only language should be updated incrementally')
+
+    monkeypatch.setattr(index, 'update_translation_stats', _recount)
+    lines = index.get_untranslated_lines('en')
+    index.update_translations('en', [(tid, 'T' + text) for tid, text in lines[:4]])
+    assert tuple(index._stats['string']['en']) == (4, 6)
+
+
+def test_stats_are_recounted_after_a_crash(tmp_path, monkeypatch, db_engine):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('projz/tmp')
+    index = TranslationIndex(Project(str(tmp_path / 'game'), 'x', 'crash'), 'crash', 'sqlite')
+    index.save()
+    with index._open_db() as dao:
+        dlang, slang = index._get_table_name('en')
+        dao.add_batch(slang, [ast_of(identifier=f's{i}', language='en', filename='a.rpy', linenumber=i,
+                                     block=[block_of(type='String', what=f'hi {i}', new_code=None)])
+                              for i in range(10)])
+    index.update_translation_stats('en')
+    lines = index.get_untranslated_lines('en')
+
+    # translations are committed, but index.db is not flushed before the crash
+    base._enter_context()
+    index.update_translations('en', [(tid, 'T' + text) for tid, text in lines[:4]])
+    base._DB_POOL.clear()
+    base._CONTEXT_CNT = 0
+    TranslationIndex._DIRTY_MARKS.clear()
+
+    index = TranslationIndex.from_docid_or_nickname(nickname='crash')
+    assert tuple(index._stats['string']['en']) == (0, 10) and index._stats['dirty'] == ['en']
+    index.update_translations('en', [lines[4]])
+    assert tuple(index._stats['string']['en']) == (5, 5) and index._stats['dirty'] == []
@@ -0,0 +1,39 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trans import Translator
+from trans.placeholder import PlaceholderTranslator
+from translator.base.template import translated_pairs
+
+
+class _DropPlaceholders(Translator):
+    def translate(self, text: str) -> str:
+        return text.replace('<0>', '').upper()
+
+    def translate_batch(self, texts):
+        return [self.translate(t) for t in texts]
+
+
+def test_rejected_lines_are_not_translated():
+    translator = PlaceholderTranslator(_DropPlaceholders(), max_retries=1)
+    new_texts = translator.translate_batch(['hello', 'hello, [mc]'])
+    assert new_texts == ['HELLO', None]
+    assert translator.n_rejected == 1
+    assert translated_pairs(['a', 'b'], new_texts) == [('a', 'HELLO')]
@@ -0,0 +1,49 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tinydb import TinyDB, JSONStorage
+
+from store.database.storage import LazyJSONStorage, LazyTables, _Unloaded
+
+
+def test_legacy_db_is_read_without_rewriting(tmp_path):
+    db_file = str(tmp_path / 'legacy.db')
+    with TinyDB(db_file, encoding='utf-8', ensure_ascii=False, storage=JSONStorage) as db:
+        db.table('Den').insert_multiple([{'block': [{'what': f'你好 {i}', 'new_code': None}]} for i in range(5)])
+        db.table('Sen').insert({'block': [{'what': 'hi "there"', 'new_code': '嗨'}]})
+    with open(db_file, 'rb') as f:
+        raw = f.read()
+    mtime_ns = os.stat(db_file).st_mtime_ns
+
+    storage = LazyJSONStorage(db_file, encoding='utf-8', ensure_ascii=False)
+    data = storage.read()
+    storage.close()
+    with open(db_file, 'rb') as f:
+        assert f.read() == raw
+    assert os.stat(db_file).st_mtime_ns == mtime_ns
+    assert os.path.isfile(storage.manifest_file)
+
+    # tables are loaded lazily by the manifest next time
+    storage = LazyJSONStorage(db_file, encoding='utf-8', ensure_ascii=False)
+    lazy_data = storage.read()
+    assert isinstance(lazy_data, LazyTables)
+    assert all(isinstance(v, _Unloaded) for _, v in lazy_data.raw_items())
+    assert dict(lazy_data.items()) == dict(data.items())
+    storage.close()
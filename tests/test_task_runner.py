@@ -0,0 +1,48 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pytest
+
+import translator.base.thread as thread
+from translator.base.template import TranslatorTemplate
+
+
+class _Upper(TranslatorTemplate):
+    def translate(self, text: str) -> str:
+        return text.upper()
+
+    def translate_batch(self, texts):
+        return [self.translate(t) for t in texts]
+
+    def memorized(self):
+        return self
+
+
+def test_writer_failure_stops_all_workers(monkeypatch):
+    monkeypatch.setattr(thread, 'yes', lambda prompt: True)
+
+    def _update(tids_and_text):
+        raise IOError('disk is full')
+
+    config = {'translator': {'write_cache_size': 1, 'write_flush_interval': 0.1}}
+    runner = thread.TranslationTaskRunner(None, config, _Upper, 0, 2, True, wait_for_init=False)
+    runner.MAX_ATTEMPTS = 1
+    with pytest.raises(Exception):
+        runner.invoke([(f't{i}', f'line {i}') for i in range(40)], _update)
+    assert runner._stop_flag
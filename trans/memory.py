@@ -0,0 +1,225 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from typing import List, Dict, Optional, Iterable, Tuple
+
+from config import default_config
+from trans.base import Translator
+
+_WHITESPACES = re.compile(r'\s+')
+
+_MEMORY = None
+_MEMORY_LOCK = threading.Lock()
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize a source text, so texts only differ in unicode forms or whitespaces share the same entry.
+    """
+    return _WHITESPACES.sub(' ', unicodedata.normalize('NFC', text)).strip()
+
+
+def prompt_hash(prompt) -> str:
+    """
+    Hash a prompt (a str, or any json serializable object like chat messages and completion args).
+    """
+    if prompt is None:
+        return ''
+    if not isinstance(prompt, str):
+        prompt = json.dumps(prompt, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+
+
+class MemoryNamespace:
+    """
+    Translations are only shared between translators with the same provider, model, target language and prompt.
+    """
+    __slots__ = ('provider', 'model', 'target_lang', 'prompt_hash')
+
+    def __init__(self, provider: str, model: str = None, target_lang: str = None, prompt=None):
+        self.provider = provider
+        self.model = model
+        self.target_lang = target_lang
+        self.prompt_hash = prompt_hash(prompt)
+
+    def key_of(self, text: str) -> str:
+        key = json.dumps([self.provider, self.model, self.target_lang, self.prompt_hash, normalize_text(text)],
+                         ensure_ascii=False)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def __repr__(self):
+        return f'{self.provider}/{self.model}/{self.target_lang}'
+
+
+class TranslationMemory:
+    """
+    An on-disk (SQLite) translation memory with a size-bounded LRU eviction.
+    """
+
+    def __init__(self, db_file: str, max_entries: int = 200000):
+        assert max_entries > 0, f'max_entries({max_entries}) should be greater than 0!'
+        self.db_file = db_file
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        dirname = os.path.dirname(db_file)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS projz_memory '
+                           '(key TEXT PRIMARY KEY, namespace TEXT, source TEXT, target TEXT, '
+                           'last_used INTEGER NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS projz_memory_lru ON projz_memory (last_used)')
+        self._conn.commit()
+        row = self._conn.execute('SELECT MAX(last_used), COUNT(*) FROM projz_memory').fetchone()
+        # a logical clock, it is more reliable than wall time for ordering
+        self._clock = row[0] or 0
+        self._size = row[1]
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def get_batch(self, namespace: MemoryNamespace, texts: Iterable[str]) -> Dict[str, str]:
+        """
+        Look up translations of texts.
+
+        :return: A dict of {text: translation} for texts found in the memory
+        """
+        texts = list(texts)
+        keys = {}
+        for t in texts:
+            keys.setdefault(namespace.key_of(t), []).append(t)
+        res = {}
+        if not keys:
+            return res
+        with self._lock:
+            key_list = list(keys.keys())
+            for i in range(0, len(key_list), 500):
+                chunk = key_list[i:i + 500]
+                rows = self._conn.execute(
+                    f'SELECT key, target FROM projz_memory WHERE key IN ({",".join("?" * len(chunk))})',
+                    chunk).fetchall()
+                for key, target in rows:
+                    for t in keys[key]:
+                        res[t] = target
+                if rows:
+                    tick = self._tick()
+                    self._conn.executemany('UPDATE projz_memory SET last_used=? WHERE key=?',
+                                           [(tick, key) for key, _ in rows])
+            self._conn.commit()
+            n_found = sum(1 for t in texts if t in res)
+            self.hits += n_found
+            self.misses += len(texts) - n_found
+        return res
+
+    def put_batch(self, namespace: MemoryNamespace, texts_and_translations: Iterable[Tuple[str, str]]):
+        """
+        Save translations, and evict the least recently used ones if the memory is full.
+        """
+        with self._lock:
+            tick = self._tick()
+            rows = [(namespace.key_of(s), repr(namespace), s, t, tick) for s, t in texts_and_translations]
+            if not rows:
+                return
+            before = self._conn.total_changes
+            self._conn.executemany('INSERT OR IGNORE INTO projz_memory VALUES (?, ?, ?, ?, ?)', rows)
+            self._size += self._conn.total_changes - before
+            self._conn.executemany('UPDATE projz_memory SET target=?, last_used=? WHERE key=?',
+                                   [(r[3], tick, r[0]) for r in rows])
+            if self._size > self.max_entries:
+                n_evicted = self._size - self.max_entries
+                self._conn.execute('DELETE FROM projz_memory WHERE key IN '
+                                   '(SELECT key FROM projz_memory ORDER BY last_used LIMIT ?)', (n_evicted,))
+                self._size = self.max_entries
+                logging.info(f'Evicted {n_evicted} entries from the translation memory')
+            self._conn.commit()
+
+    def __len__(self):
+        return self._size
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.
+        return f'{self.hits} hit(s), {self.misses} miss(es), hit ratio: {ratio:.1%}, entries: {self._size}'
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_translation_memory() -> Optional[TranslationMemory]:
+    """
+    Return the shared TranslationMemory, or None if the translation memory is disabled in config.
+    """
+    global _MEMORY
+    mconfig = default_config['translator'].get('memory', None)
+    if not mconfig or not mconfig.get('enable', False):
+        return None
+    with _MEMORY_LOCK:
+        if _MEMORY is None:
+            db_file = mconfig.get('path', None) or os.path.join(default_config.project_path,
+                                                                'translation_memory.db')
+            _MEMORY = TranslationMemory(db_file, mconfig.get('max_entries', 200000))
+        return _MEMORY
+
+
+def is_memorable(text: str, new_text: str) -> bool:
+    # untranslated or blank lines are left for the next run
+    return isinstance(new_text, str) and new_text.strip() != '' and new_text != text
+
+
+class MemoryTranslator(Translator):
+    """
+    A Translator which looks up the TranslationMemory before sending texts to the inner translator,
+    and saves new translations to the memory.
+    """
+
+    def __init__(self, translator: Translator, namespace: MemoryNamespace, memory: TranslationMemory):
+        self._translator = translator
+        self.namespace = namespace
+        self.memory = memory
+
+    def translate(self, text: str) -> str:
+        return self.translate_batch([text])[0]
+
+    def translate_batch(self, texts: List[str]) -> List[str]:
+        found = self.memory.get_batch(self.namespace, texts)
+        missed = [t for t in texts if t not in found]
+        if missed:
+            new_texts = self._translator.translate_batch(missed)
+            if len(new_texts) != len(missed):
+                logging.warning(f'Returned translated texts are expected with size of {len(missed)}, '
+                                f'but got {len(new_texts)}')
+                # leave the error to the caller, its length check must see the mismatch
+                return new_texts
+            self.memory.put_batch(self.namespace, [(t, n) for t, n in zip(missed, new_texts) if is_memorable(t, n)])
+            found = dict(found)
+            found.update(zip(missed, new_texts))
+        return [found[t] for t in texts]
+
+    def close(self):
+        self._translator.close()
@@ -13,14 +13,25 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
 import copy
 import logging
 import time
+from typing import List, Optional
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, APIConnectionError, RateLimitError, InternalServerError
 
 from config import default_config
 from trans import Translator
+from trans.ratelimit import get_rate_limiter, Retry
+
+# APITimeoutError is a subclass of APIConnectionError
+_TRANSIENT_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
+
+def _estimate_tokens(messages) -> int:
+    # the number of characters is an upper bound of tokens for most texts, it is corrected by the usage later
+    return sum(len(m.get('content', None) or '') for m in messages)
 
 
 class SimpleMessageManager:
@@ -49,9 +60,12 @@ class SimpleMessageManager:
         return self._sys_msg + self._msgs
 
 
-class OpenAITranslator(Translator):
+class _OpenAITranslatorBase(Translator):
+    """
+    Settings shared by OpenAI translators: completion args, prompts, the rate limiter and retries.
+    """
 
-    def __init__(self, model: str = None, target_lang: str = None, max_turns: int = None, verbose: bool = True):
+    def __init__(self, model: str = None, target_lang: str = None, verbose: bool = True):
         '''
 
         :param model: The model to use.
@@ -61,8 +75,9 @@ class OpenAITranslator(Translator):
         self._target_lang = target_lang
         self._verbose = verbose
         config = default_config['translator']['open_ai']
+        self._config = config
 
-        init_args = config['init']
+        self._init_args = config['init']
         self._compl_args = copy.deepcopy(config['chat']['completions'])
         # set default model
         if model is not None:
@@ -70,40 +85,68 @@ class OpenAITranslator(Translator):
         # set target_lang model
         if self._target_lang is None:
             self._target_lang = config.get('target_lang', 'Chinese')
-        self._msgs = copy.deepcopy(self._compl_args['messages'])
+        msgs = copy.deepcopy(self._compl_args['messages'])
         # find use message
         use_role = config.get('user_role', 'user')
         self._user_msg = None
-        for m in self._msgs:
+        for m in msgs:
             if m['role'] == use_role:
                 self._user_msg = copy.deepcopy(m)
         if self._user_msg is None:
             raise ValueError(f'Message with role={use_role} not found!')
         # find system message
-        sys_msg = None
-        for m in self._msgs:
+        self._sys_msg = None
+        for m in msgs:
             if m['role'] == 'system':
-                sys_msg = copy.deepcopy(m)
-                sys_msg['content'] = sys_msg['content'].format(target_lang=self._target_lang)
+                self._sys_msg = copy.deepcopy(m)
+                self._sys_msg['content'] = self._sys_msg['content'].format(target_lang=self._target_lang)
+        self.token_count = 0
+        rate_config = config.get('rate_limit', None)
+        self._limiter = get_rate_limiter('open_ai', self._init_args.get('base_url', None) or 'default', rate_config)
+        self._retry = Retry.from_config(rate_config, _TRANSIENT_ERRORS)
+
+    def _client_args(self) -> dict:
+        # requests are retried by self._retry, the client should not retry them again
+        return dict(self._init_args, max_retries=0)
+
+    def _user_msg_of(self, text: str) -> dict:
+        user_msg = self._user_msg.copy()
+        user_msg['content'] = self._user_msg['content'].format(target_lang=self._target_lang, text=text)
+        return user_msg
+
+
+class OpenAITranslator(_OpenAITranslatorBase):
+
+    def __init__(self, model: str = None, target_lang: str = None, max_turns: int = None, verbose: bool = True):
+        '''
+
+        :param model: The model to use.
+        :param target_lang: The {target_lang} in the prompt.
+        :param verbose: Print translation info
+        '''
+        super().__init__(model, target_lang, verbose)
         # Manage messages
         if max_turns is None:
-            max_turns = config.get('max_turns', 8)
+            max_turns = self._config.get('max_turns', 8)
         print(f'Max turn for chat is set to: {max_turns}')
         self._msg_manager = SimpleMessageManager(max_turns)
-        if sys_msg is not None:
-            self._msg_manager.set_system_msg(sys_msg)
-        self.token_count = 0
-        self._client = OpenAI(**init_args)
+        if self._sys_msg is not None:
+            self._msg_manager.set_system_msg(self._sys_msg)
+        self._client = OpenAI(**self._client_args())
+
+    def _create(self, est_tokens: int):
+        self._limiter.acquire(est_tokens)
+        return self._client.chat.completions.create(**self._compl_args)
 
     def translate(self, text: str) -> str:
         st_time = time.time()
-        user_msg = self._user_msg.copy()
-        user_msg['content'] = self._user_msg['content'].format(target_lang=self._target_lang, text=text)
+        user_msg = self._user_msg_of(text)
         self._compl_args['messages'] = self._msg_manager.to_list() + [user_msg]
         # print(f'Chat History: {len(self._msg_manager)}')
         # for m in self._msg_manager.to_list():
         #     print(f'\t{m}')
-        chat_completion = self._client.chat.completions.create(**self._compl_args)
+        est_tokens = _estimate_tokens(self._compl_args['messages'])
+        chat_completion = self._retry.call(self._create, est_tokens)
         assistant_msg = chat_completion.choices[0].message
         assistant_msg = {'role':assistant_msg.role, 'content': assistant_msg.content}
 
@@ -112,6 +155,7 @@ class OpenAITranslator(Translator):
 
         new_text = assistant_msg['content'].rstrip()
         use_token = chat_completion.usage.total_tokens
+        self._limiter.consume(use_token - est_tokens)
         self.token_count += use_token
         if self._verbose:
             print(
@@ -124,3 +168,82 @@ class OpenAITranslator(Translator):
             self._client.close()
         except Exception as e:
             logging.exception(e)
+
+
+class AsyncOpenAITranslator(_OpenAITranslatorBase):
+
+    def __init__(self, model: str = None, target_lang: str = None, concurrency: int = None, verbose: bool = True):
+        '''
+        Translate texts by sending requests of AsyncOpenAI concurrently.
+        As requests are sent at the same time, no chat history is kept, each request only has the system message.
+        An instance runs requests in its own event loop, so it is not thread-safe and should not be shared
+        across threads.
+
+        :param model: The model to use.
+        :param target_lang: The {target_lang} in the prompt.
+        :param concurrency: The max number of requests in flight.
+        :param verbose: Print translation info
+        '''
+        super().__init__(model, target_lang, verbose)
+        if concurrency is None:
+            concurrency = self._config.get('concurrency', 1)
+        assert concurrency > 0, f'concurrency({concurrency}) should be greater than 0!'
+        self.concurrency = concurrency
+        self._sys_msgs = [self._sys_msg] if self._sys_msg is not None else []
+        print(f'Max number of concurrent requests is set to: {concurrency}')
+        # all requests run in this loop, so the connection pool of the client is reused
+        self._loop = asyncio.new_event_loop()
+        self._client = AsyncOpenAI(**self._client_args())
+
+    async def _create(self, compl_args: dict, est_tokens: int):
+        await self._limiter.acquire_async(est_tokens)
+        return await self._client.chat.completions.create(**compl_args)
+
+    async def _translate(self, sem: asyncio.Semaphore, text: str) -> str:
+        async with sem:
+            st_time = time.time()
+            user_msg = self._user_msg_of(text)
+            compl_args = self._compl_args.copy()
+            compl_args['messages'] = self._sys_msgs + [user_msg]
+            est_tokens = _estimate_tokens(compl_args['messages'])
+            chat_completion = await self._retry.call_async(self._create, compl_args, est_tokens)
+        new_text = chat_completion.choices[0].message.content.rstrip()
+        use_token = chat_completion.usage.total_tokens
+        self._limiter.consume(use_token - est_tokens)
+        self.token_count += use_token
+        if self._verbose:
+            print(
+                f'[Elapsed: {time.time() - st_time:.1f}s, TOKENS: USE {use_token}, ACC. {self.token_count}]: {text}->{new_text}')
+        return new_text
+
+    async def _translate_all(self, texts: List[str]) -> List[Optional[str]]:
+        sem = asyncio.Semaphore(self.concurrency)
+        # gather() returns results in the order of texts. A failed request does not fail others,
+        # so tokens spent by them are not wasted.
+        results = await asyncio.gather(*[self._translate(sem, t) for t in texts], return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            if len(errors) == len(results):
+                raise errors[0]
+            for e in errors:
+                logging.error(f'Request failed: {e.__class__.__name__}: {e}')
+            print(f'{len(errors)} of {len(texts)} requests are failed, these texts are left untranslated.')
+        # None for failed requests, they are not translated
+        return [None if isinstance(r, BaseException) else r for r in results]
+
+    def translate(self, text: str) -> str:
+        return self.translate_batch([text])[0]
+
+    def translate_batch(self, texts: List[str]) -> List[Optional[str]]:
+        if not texts:
+            return []
+        return self._loop.run_until_complete(self._translate_all(texts))
+
+    def close(self):
+        try:
+            print('Closing the AsyncOpenAI client...')
+            self._loop.run_until_complete(self._client.close())
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            self._loop.close()
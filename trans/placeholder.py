@@ -0,0 +1,145 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import logging
+import re
+from collections import Counter
+from typing import List, Tuple, Optional
+
+from config import default_config
+from trans.base import Translator
+from util.renpy import list_vars, list_tags, list_escape_chars
+
+PLACEHOLDER = '<{}>'
+# translators may add spaces into placeholders
+_PLACEHOLDER_RE = re.compile(r'<\s*(\d+)\s*>')
+
+
+def _escape_chars_of(text: str) -> List[str]:
+    # '\\\\' goes first, so the backslash of an escaped backslash is not taken by others (e.g., '\\n')
+    return sorted(list_escape_chars(text).keys(), key=lambda c: c != '\\\\')
+
+
+def mask_placeholders(text: str) -> Tuple[str, List[str]]:
+    """
+    Replace escape chars, [variables] and {tags} of RenPy in the text with placeholders like <0>, <1>, ...
+    The same span shares a placeholder.
+
+    :return: The masked text and the spans of placeholders. No span is masked if the text contains placeholder-like
+        strings already.
+    """
+    if not isinstance(text, str) or _PLACEHOLDER_RE.search(text):
+        return text, []
+    spans = []
+    for list_func in (_escape_chars_of, list_vars, list_tags):
+        # find spans in the masked text, so escaped brackets are not taken as variables or tags
+        for span in list_func(text):
+            # a span containing a placeholder (e.g., a tag with escape chars) is left as it is
+            if span in text and not _PLACEHOLDER_RE.search(span):
+                text = text.replace(span, PLACEHOLDER.format(len(spans)))
+                spans.append(span)
+    return text, spans
+
+
+def unmask_placeholders(masked_text: str, new_text: str, spans: List[str]) -> Optional[str]:
+    """
+    Restore spans of placeholders in the translation of the masked text.
+
+    :return: None if placeholders are lost, duplicated, or unknown in the translation
+    """
+    if not spans:
+        return new_text
+    if not isinstance(new_text, str):
+        return None
+    if Counter(_PLACEHOLDER_RE.findall(new_text)) != Counter(_PLACEHOLDER_RE.findall(masked_text)):
+        return None
+    return _PLACEHOLDER_RE.sub(lambda m: spans[int(m.group(1))], new_text)
+
+
+class PlaceholderTranslator(Translator):
+    """
+    A Translator which masks RenPy variables, tags and escape chars with short placeholders before sending texts
+    to the inner translator, and restores them in translations. Texts whose placeholders don't round-trip are
+    sent again (up to max_retries times), then rejected, i.e., None is returned for them, so they are left
+    untranslated instead of taking the source text as a translation.
+    """
+
+    def __init__(self, translator: Translator, max_retries: int = 1):
+        assert max_retries >= 0, f'max_retries({max_retries}) should not be less than 0!'
+        self._translator = translator
+        self.max_retries = max_retries
+        self.n_masked = 0
+        self.n_saved_chars = 0
+        self.n_retried = 0
+        self.n_rejected = 0
+
+    def translate(self, text: str) -> str:
+        return self.translate_batch([text])[0]
+
+    def translate_batch(self, texts: List[str]) -> List[Optional[str]]:
+        masked = [mask_placeholders(t) for t in texts]
+        for t, (m, spans) in zip(texts, masked):
+            if spans:
+                self.n_masked += 1
+                self.n_saved_chars += len(t) - len(m)
+        results = [None] * len(texts)
+        pending = list(range(len(texts)))
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                print(f'Retrying {len(pending)} line(s) whose placeholders are broken '
+                      f'({attempt}/{self.max_retries})')
+                self.n_retried += len(pending)
+            new_texts = self._translator.translate_batch([masked[i][0] for i in pending])
+            if len(new_texts) != len(pending):
+                logging.warning(f'Returned translated texts are expected with size of {len(pending)}, '
+                                f'but got {len(new_texts)}')
+                if attempt == 0:
+                    # leave the error to the caller
+                    return new_texts
+                break
+            failed = []
+            for i, new_text in zip(pending, new_texts):
+                if new_text is None:
+                    # not translated by the inner translator, e.g., its request failed
+                    continue
+                restored = unmask_placeholders(masked[i][0], new_text, masked[i][1])
+                if restored is None:
+                    failed.append(i)
+                else:
+                    results[i] = restored
+            pending = failed
+            if not pending:
+                break
+        for i in pending:
+            print(f'Rejected the translation with broken placeholders: {texts[i]}')
+            self.n_rejected += 1
+        return results
+
+    def stats(self) -> str:
+        return (f'{self.n_masked} line(s) masked, {self.n_saved_chars} char(s) saved, '
+                f'{self.n_retried} retried, {self.n_rejected} rejected')
+
+    def close(self):
+        self._translator.close()
+
+
+def get_placeholder_translator(translator: Translator) -> Translator:
+    """
+    Wrap the translator with a PlaceholderTranslator if it's enabled in config.
+    """
+    pconfig = default_config['translator'].get('placeholder', None)
+    if translator is None or not pconfig or not pconfig.get('enable', False):
+        return translator
+    return PlaceholderTranslator(translator, pconfig.get('max_retries', 1))
@@ -0,0 +1,235 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional, Tuple, Type, Dict, Mapping
+
+# request timeout and too many requests, besides 5xx
+_TRANSIENT_STATUS = {408, 429}
+
+_LIMITERS: Dict[Tuple[str, str], 'RateLimiter'] = dict()
+_LIMITERS_LOCK = threading.Lock()
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket. Tokens are reserved in advance, so the bucket may go into debt,
+    and callers wait for the time returned by reserve() outside the lock.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        assert rate > 0, f'rate({rate}) should be greater than 0!'
+        assert capacity > 0, f'capacity({capacity}) should be greater than 0!'
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self, n: float = 1) -> float:
+        """
+        Take n tokens.
+
+        :return: Seconds to wait before the tokens are available
+        """
+        with self._lock:
+            self._refill()
+            # a request larger than the capacity is allowed once the bucket is full
+            n = min(n, self.capacity)
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0.
+            return -self._tokens / self.rate
+
+    def consume(self, n: float):
+        """
+        Take (or give back if n < 0) tokens without waiting, e.g., correcting an estimated token usage.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens - n)
+
+
+class RateLimiter:
+    """
+    Limit requests per second and tokens per minute of an endpoint of a provider. A limit of 0 means unlimited.
+    """
+
+    def __init__(self, requests_per_second: float = 0, tokens_per_minute: float = 0):
+        self.requests_per_second = requests_per_second
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = TokenBucket(requests_per_second, max(1., requests_per_second)) \
+            if requests_per_second > 0 else None
+        self._tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute > 0 else None
+
+    @property
+    def enabled(self):
+        return self._requests is not None or self._tokens is not None
+
+    def _reserve(self, tokens: float) -> float:
+        wait = 0.
+        if self._requests is not None:
+            wait = self._requests.reserve(1)
+        if self._tokens is not None and tokens > 0:
+            wait = max(wait, self._tokens.reserve(tokens))
+        return wait
+
+    def acquire(self, tokens: float = 0):
+        """
+        Block until a request with the estimated number of tokens can be sent.
+        """
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: float = 0):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def consume(self, tokens: float):
+        """
+        Record tokens used more (or less if tokens < 0) than the estimation passed to acquire().
+        """
+        if self._tokens is not None and tokens != 0:
+            self._tokens.consume(tokens)
+
+
+def get_rate_limiter(provider: str, endpoint: str, rate_config: Optional[Mapping]) -> RateLimiter:
+    """
+    Return the RateLimiter shared by all translators of the endpoint of the provider.
+
+    :param rate_config: A dict with requests_per_second and tokens_per_minute, None means unlimited
+    """
+    rate_config = rate_config or {}
+    key = (provider, endpoint)
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(key, None)
+        rps = float(rate_config.get('requests_per_second', 0) or 0)
+        tpm = float(rate_config.get('tokens_per_minute', 0) or 0)
+        if limiter is None or (limiter.requests_per_second, limiter.tokens_per_minute) != (rps, tpm):
+            limiter = RateLimiter(rps, tpm)
+            _LIMITERS[key] = limiter
+            if limiter.enabled:
+                print(f'Rate limit of {provider} ({endpoint}): {rps} requests/s, {tpm} tokens/min')
+        return limiter
+
+
+def retry_after_of(e: BaseException) -> Optional[float]:
+    """
+    Seconds to wait told by the Retry-After (or retry-after-ms) header of the response of a failed request.
+
+    :return: None if the header is not found
+    """
+    headers = getattr(getattr(e, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        value = headers.get('retry-after-ms', None)
+        if value is not None:
+            return float(value) / 1000
+        value = headers.get('retry-after', None)
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            # an HTTP date
+            return max(0., parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_transient_error(e: BaseException, transient_types: Tuple[Type[BaseException], ...] = ()) -> bool:
+    """
+    Whether a request failed by e is worth retrying, like timeouts, connection errors and 408/429/5xx responses.
+    """
+    if isinstance(e, (TimeoutError, ConnectionError) + tuple(transient_types)):
+        return True
+    status = getattr(e, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(e, 'response', None), 'status_code', None)
+    return isinstance(status, int) and (status in _TRANSIENT_STATUS or 500 <= status < 600)
+
+
+class Retry:
+    """
+    Retry transient errors with a jittered exponential backoff (full jitter),
+    or the delay told by the Retry-After header of the response if it's present, both are capped by max_delay.
+    """
+
+    def __init__(self, max_retries: int = 5, base_delay: float = 1., max_delay: float = 60.,
+                 transient_types: Tuple[Type[BaseException], ...] = ()):
+        assert max_retries >= 0, f'max_retries({max_retries}) should not be less than 0!'
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.transient_types = tuple(transient_types)
+
+    @classmethod
+    def from_config(cls, rate_config: Optional[Mapping], transient_types: Tuple[Type[BaseException], ...] = ()):
+        rate_config = rate_config or {}
+        return cls(max_retries=rate_config.get('max_retries', 5),
+                   base_delay=rate_config.get('retry_base_delay', 1.),
+                   max_delay=rate_config.get('retry_max_delay', 60.),
+                   transient_types=transient_types)
+
+    def _delay_of(self, attempt: int, e: BaseException) -> Optional[float]:
+        if attempt >= self.max_retries or not is_transient_error(e, self.transient_types):
+            return None
+        delay = retry_after_of(e)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        # a bad Retry-After header should not stall the worker
+        delay = min(delay, self.max_delay)
+        print(f'Request failed ({e.__class__.__name__}: {e}), retry {attempt + 1}/{self.max_retries} '
+              f'in {delay:.1f}s')
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                delay = self._delay_of(attempt, e)
+                if delay is None:
+                    raise
+                logging.debug(f'Retrying {func}: {e}')
+                time.sleep(delay)
+                attempt += 1
+
+    async def call_async(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                delay = self._delay_of(attempt, e)
+                if delay is None:
+                    raise
+                logging.debug(f'Retrying {func}: {e}')
+                await asyncio.sleep(delay)
+                attempt += 1
@@ -17,7 +17,9 @@ import time
 
 from config import default_config
 from trans import Translator
+from trans.ratelimit import get_rate_limiter, Retry
 
+import requests
 import translators as ts
 
 _preacceleration_done = False
@@ -58,11 +60,22 @@ class TranslatorsTranslator(Translator):
         self.trans_kwargs.pop('translator', None)
         self.trans_kwargs.pop('from_language', None)
         self.trans_kwargs.pop('to_language', None)
+        rate_config = tconfig.get('rate_limit', None)
+        self._limiter = get_rate_limiter('translators', self._api, rate_config)
+        self._retry = Retry.from_config(rate_config, (requests.ConnectionError, requests.Timeout))
+        if self._limiter.enabled and self.trans_kwargs.get('sleep_seconds', 0):
+            # the limiter sends requests at the configured rate instead of a fixed sleep
+            print(f'Ignoring translate_text.sleep_seconds ({self.trans_kwargs["sleep_seconds"]}) as rate_limit is set.')
+            self.trans_kwargs = dict(self.trans_kwargs, sleep_seconds=0)
+
+    def _translate(self, text: str):
+        self._limiter.acquire()
+        return ts.translate_text(text, from_language=self._source, to_language=self._target,
+                                 translator=self._api, **self.trans_kwargs)
 
     def translate(self, text: str) -> str:
         st_time = time.time()
-        res = ts.translate_text(text, from_language=self._source, to_language=self._target,
-                                translator=self._api, **self.trans_kwargs)
+        res = self._retry.call(self._translate, text)
         if self._verbose:
             print(f'[Elapsed: {time.time() - st_time:.1f}s]: {text}->{res}')
         return res
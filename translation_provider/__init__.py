@@ -24,4 +24,8 @@ except Exception as e:
 try:
     import translation_provider.closeapi
 except Exception as e:
-    logging.exception(e)
\ No newline at end of file
+    logging.exception(e)
+try:
+    import translation_provider.hedged
+except Exception as e:
+    logging.exception(e)
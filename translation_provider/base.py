@@ -17,6 +17,8 @@ from typing import List, Tuple
 
 from config.base import default_config
 from trans import Translator
+from trans.memory import MemoryNamespace, MemoryTranslator, get_translation_memory
+from trans.placeholder import get_placeholder_translator
 
 _API_PROVIDERS = {}
 
@@ -85,6 +87,28 @@ class Provider:
     def translator_of(self, api: str, source_lang: str, target_lang: str) -> Translator:
         raise NotImplementedError()
 
+    def memory_namespace(self, api: str, source_lang: str, target_lang: str) -> MemoryNamespace:
+        '''
+        return the namespace of translations of translator_of() in the translation memory
+        :return: None if translations should not be memorized
+        '''
+        return None
+
+    def memorized_translator_of(self, api: str, source_lang: str, target_lang: str) -> Translator:
+        """
+        return translator_of() which looks up the translation memory before translating,
+        with RenPy variables, tags and escape chars masked by placeholders if translator.placeholder is enabled
+        :return:
+        """
+        translator = get_placeholder_translator(self.translator_of(api, source_lang, target_lang))
+        memory = get_translation_memory()
+        if translator is None or memory is None:
+            return translator
+        namespace = self.memory_namespace(api, source_lang, target_lang)
+        if namespace is None:
+            return translator
+        return MemoryTranslator(translator, namespace, memory)
+
 
 def registered_providers():
     return list(_API_PROVIDERS.keys())
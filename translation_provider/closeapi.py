@@ -15,10 +15,11 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from trans.openai_api import OpenAITranslator
 from trans import Translator
+from trans.memory import MemoryNamespace
 from translation_provider.base import Provider, register_provider
 from util import strip_or_none
 from util.renpy import strip_tags
-from util.translate import BatchTranslator
+from util.translate import BatchTranslator, get_token_counter
 
 
 class _InnerTranslator(Translator):
@@ -81,8 +82,15 @@ class OpenAIApi(Provider):
         _separator = self.oconfig['batch_separator']
         _max_len = self.oconfig['batch_max_textlen']
         _batch_size = self.oconfig['batch_size']
+        token_counter = get_token_counter(self.oconfig.get('batch_tokenizer', 'char'), api)
         return BatchTranslator(_InnerTranslator(api, source_lang, target_lang),
-                               _separator, _max_len, _batch_size)
+                               _separator, _max_len, _batch_size, token_counter=token_counter)
+
+    def memory_namespace(self, api: str, source_lang: str, target_lang: str):
+        prompt = dict(self.oconfig['chat']['completions'])
+        prompt.pop('model', None)
+        prompt.pop('stream', None)
+        return MemoryNamespace('CloseAI', api, target_lang, prompt)
 
 
 register_provider('CloseAI', OpenAIApi())
@@ -0,0 +1,277 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import List, Tuple, Dict, Optional
+
+from trans import Translator
+from translation_provider.base import Provider, register_provider, get_provider
+
+_STATS: Dict[str, 'LatencyStats'] = dict()
+_STATS_LOCK = threading.Lock()
+
+
+class LatencyStats:
+    """
+    Latencies of the recent successful requests of a backend, shared by all HedgedTranslators.
+    """
+
+    def __init__(self, window: int = 100):
+        self._latencies = deque(maxlen=max(window, 1))
+        self._lock = threading.Lock()
+        self.counts = {'requests': 0, 'wins': 0, 'failures': 0}
+
+    def add(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def count(self, key: str):
+        with self._lock:
+            self.counts[key] += 1
+
+    def quantile(self, q: float, min_samples: int = 5) -> Optional[float]:
+        """
+        :return: None if there are not enough samples
+        """
+        with self._lock:
+            if len(self._latencies) < min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def __str__(self):
+        p50, p95 = self.quantile(0.5, 1), self.quantile(0.95, 1)
+        latency = f'p50: {p50:.2f}s, p95: {p95:.2f}s' if p50 is not None else 'no latency'
+        return (f'{self.counts["requests"]} request(s), {self.counts["wins"]} won, '
+                f'{self.counts["failures"]} failed, {latency}')
+
+
+def get_latency_stats(name: str, window: int = 100) -> LatencyStats:
+    with _STATS_LOCK:
+        stats = _STATS.get(name, None)
+        if stats is None:
+            stats = LatencyStats(window)
+            _STATS[name] = stats
+        return stats
+
+
+def _is_valid(texts: List[str], new_texts) -> bool:
+    # None is a text left untranslated by the backend, but an answer translating nothing is not valid
+    return isinstance(new_texts, list) and len(new_texts) == len(texts) and all(
+        t is None or isinstance(t, str) for t in new_texts) and (
+            len(texts) == 0 or any(isinstance(t, str) for t in new_texts))
+
+
+class HedgedTranslator(Translator):
+    """
+    A Translator which sends a request to the first backend, and if no answer arrives within the deadline
+    (the quantile of latencies of that backend), hedges the request to the next backend, and so on.
+    The first valid answer is taken. Requests which are not started yet are cancelled, and answers of
+    requests already sent are dropped (a running HTTP request can't be interrupted).
+    """
+
+    def __init__(self, backends: List[Tuple[str, Translator]], quantile: float = 0.95, min_delay: float = 0.3,
+                 max_delay: float = 3., window: int = 100):
+        '''
+
+        :param backends: (name, translator) in the order of preference
+        :param quantile: The quantile of latencies used as the deadline of a backend
+        :param min_delay: The min deadline
+        :param max_delay: The max deadline, also used when a backend has too few latency samples
+        :param window: The number of latencies kept for each backend
+        '''
+        assert len(backends) > 0, 'No backend for the HedgedTranslator!'
+        assert 0 < quantile <= 1, f'quantile({quantile}) should be in (0, 1]!'
+        self._backends = backends
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.max_delay = max(max_delay, min_delay)
+        self._stats = [get_latency_stats(name, window) for name, _ in backends]
+        # a pool for each backend, so late requests of a slow backend don't queue up requests of others.
+        # late requests may still be running when the next batch comes
+        self._executors = [ThreadPoolExecutor(max_workers=2, thread_name_prefix=f'hedged-{i}')
+                           for i in range(len(backends))]
+        self._futures = set()
+        self._futures_lock = threading.Lock()
+
+    def deadline_of(self, i: int) -> float:
+        latency = self._stats[i].quantile(self.quantile)
+        if latency is None:
+            return self.max_delay
+        return min(self.max_delay, max(self.min_delay, latency))
+
+    def _call(self, i: int, texts: List[str]):
+        st_time = time.monotonic()
+        stats = self._stats[i]
+        stats.count('requests')
+        try:
+            new_texts = self._backends[i][1].translate_batch(texts)
+        except Exception:
+            stats.count('failures')
+            raise
+        if _is_valid(texts, new_texts):
+            stats.add(time.monotonic() - st_time)
+        else:
+            stats.count('failures')
+        return new_texts
+
+    def _submit(self, i: int, texts: List[str]) -> Future:
+        future = self._executors[i].submit(self._call, i, texts)
+        with self._futures_lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future: Future):
+        with self._futures_lock:
+            self._futures.discard(future)
+
+    def translate_batch(self, texts: List[str]) -> List[str]:
+        futures = dict()
+        next_backend = 0
+        last_error = None
+        while True:
+            # the first request, or hedging as the deadline has passed or a backend failed
+            if next_backend < len(self._backends):
+                if next_backend > 0:
+                    print(f'Hedging the request to {self._backends[next_backend][0]}')
+                futures[self._submit(next_backend, texts)] = next_backend
+                next_backend += 1
+            # wait for the deadline of the last backend, or all answers if there is no more backend
+            timeout = self.deadline_of(next_backend - 1) if next_backend < len(self._backends) else None
+            done, _ = wait(futures.keys(), timeout=timeout, return_when=FIRST_COMPLETED)
+            for f in done:
+                i = futures.pop(f)
+                try:
+                    new_texts = f.result()
+                except Exception as e:
+                    logging.exception(e)
+                    last_error = e
+                    continue
+                if _is_valid(texts, new_texts):
+                    self._stats[i].count('wins')
+                    for other in futures.keys():
+                        other.cancel()
+                    return new_texts
+                last_error = ValueError(f'Invalid answer from {self._backends[i][0]}: {new_texts}')
+            if not futures and next_backend >= len(self._backends):
+                raise last_error
+
+    def translate(self, text: str) -> str:
+        return self.translate_batch([text])[0]
+
+    def stats(self) -> str:
+        return '\n'.join(f'{name}: {s}' for (name, _), s in zip(self._backends, self._stats))
+
+    def close(self):
+        print(f'Latencies of backends:\n{self.stats()}')
+        # shutdown(cancel_futures=True) needs python 3.9+
+        with self._futures_lock:
+            pending = list(self._futures)
+        for f in pending:
+            f.cancel()
+        for executor in self._executors:
+            executor.shutdown(wait=False)
+        for _, translator in self._backends:
+            translator.close()
+
+
+class HedgedApi(Provider):
+    """
+    A Provider of HedgedTranslators over backends of other providers, see translator.realtime.hedge in config.yaml.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.hconfig = None
+        self.reload_config()
+
+    def reload_config(self):
+        self.hconfig = self.config['translator']['realtime'].get('hedge', None) or {}
+
+    def _backends(self) -> List[dict]:
+        self.reload_config()
+        backends = []
+        for b in self.hconfig.get('backends', []):
+            if isinstance(b, str):
+                b = {'name': b}
+            provider_name, api = b['name'].split('/', 1)
+            backends.append(dict(b, provider=provider_name, api=api))
+        return backends
+
+    def api_names(self):
+        backends = self._backends()
+        if not backends:
+            return []
+        return [', '.join(b['name'] for b in backends)]
+
+    def default_api(self):
+        names = self.api_names()
+        return names[0] if names else None
+
+    def is_source_language_editable(self) -> bool:
+        return True
+
+    def is_target_language_editable(self) -> bool:
+        return True
+
+    def _primary(self) -> Tuple[Optional[Provider], Optional[str]]:
+        backends = self._backends()
+        if not backends:
+            return None, None
+        return get_provider(backends[0]['provider']), backends[0]['api']
+
+    def default_source_lang(self):
+        provider, _ = self._primary()
+        return provider.default_source_lang() if provider is not None else None
+
+    def default_target_lang(self):
+        provider, _ = self._primary()
+        return provider.default_target_lang() if provider is not None else None
+
+    def languages_of(self, api: str):
+        # languages of the primary backend, others can use their own languages in config
+        provider, primary_api = self._primary()
+        if provider is None:
+            return [], []
+        return provider.languages_of(primary_api)
+
+    def translator_of(self, api: str, source_lang: str, target_lang: str) -> Translator:
+        backends = []
+        for b in self._backends():
+            provider = get_provider(b['provider'])
+            if provider is None:
+                print(f'Ignoring the backend {b["name"]}: provider {b["provider"]} is not found')
+                continue
+            translator = provider.translator_of(b['api'], b.get('source_lang', None) or source_lang,
+                                                b.get('target_lang', None) or target_lang)
+            if translator is None:
+                print(f'Ignoring the backend {b["name"]}: unsupported languages')
+                continue
+            backends.append((b['name'], translator))
+        if not backends:
+            return None
+        print(f'Hedged backends: {", ".join(name for name, _ in backends)}')
+        return HedgedTranslator(backends, quantile=self.hconfig.get('quantile', 0.95),
+                                min_delay=self.hconfig.get('min_delay', 0.3),
+                                max_delay=self.hconfig.get('max_delay', 3.),
+                                window=self.hconfig.get('window', 100))
+
+
+register_provider('hedged', HedgedApi())
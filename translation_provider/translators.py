@@ -16,6 +16,7 @@
 from typing import List
 
 from trans import Translator
+from trans.memory import MemoryNamespace
 from trans.translators_api import TranslatorsTranslator
 from translation_provider.base import Provider, register_provider
 
@@ -66,5 +67,8 @@ class TranslatorsApi(Provider):
                                        _separator, _max_len, _batch_size)
         return None
 
+    def memory_namespace(self, api: str, source_lang: str, target_lang: str):
+        return MemoryNamespace('translators', api, target_lang, source_lang)
+
 
 register_provider('translators', TranslatorsApi())
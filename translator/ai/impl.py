@@ -14,16 +14,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import logging
+import multiprocessing
 import os
 import time
 from argparse import ArgumentParser
-from typing import List, Tuple
+from typing import List, Tuple, Optional
 
 import torch.cuda
+import tqdm
 from prettytable import PrettyTable
 
 from command.translation.base import register_cmd_translator
 from config.base import ProjzConfig
+from trans.memory import MemoryNamespace
 from translator.base import CachedTranslatorTemplate
 from util import exists_dir, strip_or_none, my_input, line_to_args
 import dl_translate as dlt
@@ -31,14 +34,74 @@ import dl_translate as dlt
 AVAILABLE_MODELS = ['m2m100', 'mbart50', 'nllb200']
 
 
+def _load_translation_model(model_name: str, model_path: Optional[str], device: str = 'auto',
+                            quantize: bool = False):
+    if model_path:
+        model_path = os.path.join(model_path, model_name)
+        assert exists_dir(model_path), f'Invalid model path: {model_path}'
+        print(f'Loading the model from: {model_path}')
+        mt = dlt.TranslationModel(model_path, device=device, model_family=model_name)
+    else:
+        mt = dlt.TranslationModel(model_name, device=device)
+    if quantize:
+        # int8 weights for Linear layers, activations are quantized on the fly. It only works on CPU.
+        # TranslationModel has no public setter of its model, so this relies on the private _transformers_model
+        # attribute of dl-translate 0.3.0 (pinned in requirements_full.txt), check it when upgrading dl-translate.
+        mt._transformers_model = torch.quantization.quantize_dynamic(mt.get_transformers_model(),
+                                                                     {torch.nn.Linear}, dtype=torch.qint8)
+    return mt
+
+
+def _set_num_threads(intra_op_threads: int, inter_op_threads: int):
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            # it can only be set once, before any inter-op parallel work
+            logging.warning(f'Failed to set inter-op threads: {e}')
+
+
+# the model replica of a worker process
+_worker_mt = None
+
+
+def _init_worker(model_name: str, model_path: Optional[str], quantize: bool, intra_op_threads: int,
+                 inter_op_threads: int):
+    global _worker_mt
+    _set_num_threads(intra_op_threads, inter_op_threads)
+    _worker_mt = _load_translation_model(model_name, model_path, 'cpu', quantize)
+
+
+def _translate_in_worker(texts: List[str], source: str, target: str) -> List[str]:
+    return _worker_mt.translate(texts, source, target, batch_size=None, verbose=False)
+
+
+def _token_lengths(mt, texts: List[str]) -> List[int]:
+    try:
+        return [len(ids) for ids in mt.get_tokenizer()(texts)['input_ids']]
+    except Exception as e:
+        logging.warning(f'Counting tokens by characters as the tokenizer failed: {e}')
+        return [len(t) for t in texts]
+
+
+def _token_lengths_in_worker(texts: List[str]) -> List[int]:
+    return _token_lengths(_worker_mt, texts)
+
+
 class DlTranslator(CachedTranslatorTemplate):
     def __init__(self):
         super().__init__()
         self._batch_size = None
+        self._max_batch_tokens = None
         self._target = None
         self._source = None
         self._model_path = None
         self._model_name = None
+        self._cpu_options = None
+        self._pool = None
+        self.mt = None
 
     def register_args(self, parser: ArgumentParser):
         super().register_args(parser)
@@ -47,23 +110,63 @@ class DlTranslator(CachedTranslatorTemplate):
         parser.add_argument('-b', '--batch_size', type=int, default=4,
                             help='The batch size for translating. Lager value may bring faster translation speed '
                                  'but consumes more GPU memory')
+        parser.add_argument('-mt', '--max_batch_tokens', type=int, default=0,
+                            help='The max number of (padded) tokens in a batch. If it is greater than 0, the batch size '
+                                 'is chosen by the lengths of texts: short texts are translated in large batches and '
+                                 'long texts in small ones, and --batch_size is ignored.')
+        parser.add_argument('--cpu', action='store_true',
+                            help='Run the model on CPU, see --quantize, --threads, --interop_threads and --num_procs.')
+        parser.add_argument('--quantize', action='store_true',
+                            help='Quantize Linear layers of the model to int8 dynamically in the CPU mode. '
+                                 'It translates faster but may lower the translation quality a little.')
+        parser.add_argument('--threads', type=int, default=0,
+                            help='The number of intra-op threads of each model in the CPU mode. '
+                                 '0 means the default of torch (or cpu_count / num_procs with --num_procs).')
+        parser.add_argument('--interop_threads', type=int, default=0,
+                            help='The number of inter-op threads of each model in the CPU mode. '
+                                 '0 means the default of torch.')
+        parser.add_argument('--num_procs', type=int, default=1,
+                            help='The number of processes in the CPU mode, each of them loads a copy of the model and '
+                                 'translates batches in parallel, which consumes more memory. With more than one '
+                                 'process, the main process does not load the model.')
         parser.add_argument("-a", "--auto", action='store_true',
                                   help="Load translation settings form config.")
 
+    def _use_pool(self):
+        return self._cpu_options is not None and self._cpu_options['num_processes'] > 1
+
     def _load_model(self):
+        if self._use_pool():
+            # only worker processes load the model, see _start_pool
+            return
         print(f'Start loading the {self._model_name} model')
         st_time = time.time()
-        if self._model_path:
-            model_path = os.path.join(self._model_path, self._model_name)
-            assert exists_dir(model_path), f'Invalid model path: {model_path}'
-            print(f'Loading the model from: {model_path}')
-            self.mt = dlt.TranslationModel(model_path, model_family=self._model_name)
+        if self._cpu_options is None:
+            self.mt = _load_translation_model(self._model_name, self._model_path)
         else:
-            self.mt = dlt.TranslationModel(self._model_name)
+            o = self._cpu_options
+            print(f'CPU mode: quantize={o["quantize"]}, intra_op_threads={o["intra_op_threads"]}, '
+                  f'inter_op_threads={o["inter_op_threads"]}, num_processes={o["num_processes"]}')
+            _set_num_threads(o['intra_op_threads'], o['inter_op_threads'])
+            self.mt = _load_translation_model(self._model_name, self._model_path, 'cpu', o['quantize'])
         print(f'The model is loaded in {time.time() - st_time:.1f}s')
 
+    def _start_pool(self):
+        o = self._cpu_options
+        num_processes = o['num_processes']
+        # avoid oversubscribing cores by replicas
+        intra_op_threads = o['intra_op_threads'] or max(1, (os.cpu_count() or 1) // num_processes)
+        print(f'Starting {num_processes} processes with {intra_op_threads} threads each')
+        ctx = multiprocessing.get_context('spawn')
+        self._pool = ctx.Pool(num_processes, initializer=_init_worker,
+                              initargs=(self._model_name, self._model_path, o['quantize'], intra_op_threads,
+                                        o['inter_op_threads']))
+
     def determine_translation_target(self):
-        ava_langs = sorted(list(self.mt.available_languages()))
+        if self.mt is None:
+            ava_langs = sorted(list(dlt.utils.available_languages(self._model_name)))
+        else:
+            ava_langs = sorted(list(self.mt.available_languages()))
         ava_indexes = list(range(len(ava_langs)))
 
         cols = 4
@@ -107,34 +210,118 @@ class DlTranslator(CachedTranslatorTemplate):
         ai_config = config['translator']['ai']
         self._model_path = strip_or_none(ai_config['model_path'])
         if self.args.auto:
+            cpu_config = ai_config.get('cpu', None)
+            if cpu_config and cpu_config['enable']:
+                self._cpu_options = {
+                    'quantize': cpu_config['quantize'],
+                    'intra_op_threads': cpu_config['intra_op_threads'],
+                    'inter_op_threads': cpu_config['inter_op_threads'],
+                    'num_processes': cpu_config['num_processes'],
+                }
             self._batch_size = ai_config['batch_size']
+            self._max_batch_tokens = ai_config.get('max_batch_tokens', 0)
             self._model_name = ai_config['model_name']
             self._source = ai_config['from_language']
             self._target = ai_config['to_language']
             print('Using config from config.yaml:')
             print(f'batch_size: {self._batch_size}')
+            print(f'max_batch_tokens: {self._max_batch_tokens}')
             print(f'model_name: {self._model_name}')
             print(f'from_language: {self._source}')
             print(f'to_language: {self._target}')
         else:
-            assert args.batch_size > 0, f'The batch_size must be greater than 0!'
+            assert args.batch_size > 0, 'The batch_size must be greater than 0!'
             self._batch_size = args.batch_size
+            self._max_batch_tokens = args.max_batch_tokens
             self._model_name = args.name
+            if args.cpu:
+                self._cpu_options = {
+                    'quantize': args.quantize,
+                    'intra_op_threads': args.threads,
+                    'inter_op_threads': args.interop_threads,
+                    'num_processes': args.num_procs,
+                }
+        if self._cpu_options is not None:
+            assert self._cpu_options['num_processes'] > 0, 'The num_procs must be greater than 0!'
         self._load_model()
-        if self.args.auto:
-            return True
-        return self.determine_translation_target()
+        if not self.args.auto and not self.determine_translation_target():
+            return False
+        if self._use_pool():
+            self._start_pool()
+        return True
 
     def close(self):
-        del self.mt
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        self.mt = None
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
 
+    def memory_namespace(self):
+        return MemoryNamespace('ai', self._model_name, self._target, self._source)
+
     def translate(self, text: str):
+        if self._pool is not None:
+            return self._pool.apply(_translate_in_worker, ([text], self._source, self._target))[0]
         return self.mt.translate(text, self._source, self._target, batch_size=1, verbose=False)
 
+    def _token_lengths(self, texts: List[str]) -> List[int]:
+        if self._pool is not None:
+            return self._pool.apply(_token_lengths_in_worker, (texts,))
+        return _token_lengths(self.mt, texts)
+
+    def _buckets(self, texts: List[str]) -> List[List[int]]:
+        """
+        Split indexes of texts into batches of similar lengths, so a long text does not pad a batch of short ones.
+        Batches are bounded by max_batch_tokens (the longest length * the batch size) if it's set,
+        otherwise by batch_size.
+        """
+        lengths = self._token_lengths(texts)
+        # longest first, so a batch running out of memory fails early
+        order = sorted(range(len(texts)), key=lambda i: lengths[i], reverse=True)
+        buckets, bucket, bucket_len = [], [], 0
+        for i in order:
+            if bucket:
+                if self._max_batch_tokens > 0:
+                    full = (len(bucket) + 1) * bucket_len > self._max_batch_tokens
+                else:
+                    full = len(bucket) >= self._batch_size
+                if full:
+                    buckets.append(bucket)
+                    bucket = []
+            if not bucket:
+                bucket_len = lengths[i]
+            bucket.append(i)
+        if bucket:
+            buckets.append(bucket)
+        return buckets
+
     def translate_batch(self, texts: List[str]):
-        return self.mt.translate(texts, self._source, self._target, batch_size=self._batch_size, verbose=True)
+        results = [None] * len(texts)
+        buckets = self._buckets(texts)
+        st_time = time.time()
+        with tqdm.tqdm(total=len(texts), desc=f'Translating in {len(buckets)} batches') as bar:
+            if self._pool is None:
+                for bucket in buckets:
+                    new_texts = self.mt.translate([texts[i] for i in bucket], self._source, self._target,
+                                                  batch_size=None, verbose=False)
+                    for i, new_text in zip(bucket, new_texts):
+                        results[i] = new_text
+                    bar.update(len(bucket))
+            else:
+                # batches are sharded across model replicas
+                tasks = [(bucket, self._pool.apply_async(_translate_in_worker,
+                                                         ([texts[i] for i in bucket], self._source, self._target)))
+                         for bucket in buckets]
+                for bucket, task in tasks:
+                    for i, new_text in zip(bucket, task.get()):
+                        results[i] = new_text
+                    bar.update(len(bucket))
+        elapsed = time.time() - st_time
+        print(f'{len(texts)} lines are translated in {elapsed:.1f}s [{len(texts) / max(elapsed, 1e-6):.2f} lines/s]')
+        return results
 
 
 register_cmd_translator('ai', DlTranslator)
@@ -18,10 +18,11 @@ from typing import List
 
 from command.translation.base import register_cmd_translator
 from config.base import ProjzConfig
-from trans.openai_api import OpenAITranslator
+from trans.memory import MemoryNamespace
+from trans.openai_api import OpenAITranslator, AsyncOpenAITranslator
 from translator.base import CachedTranslatorTemplate
 from util import strip_or_none, my_input, line_to_args
-from util.translate import BatchTranslator
+from util.translate import BatchTranslator, get_token_counter
 
 
 class OpenAILibTranslator(CachedTranslatorTemplate):
@@ -37,6 +38,10 @@ class OpenAILibTranslator(CachedTranslatorTemplate):
         super().register_args(parser)
         parser.add_argument("-a", "--auto", action='store_true',
                             help="Load translation settings form config.")
+        parser.add_argument("-c", "--concurrency", type=int, default=None,
+                            help="The max number of requests in flight. Values greater than 1 send requests "
+                                 "concurrently without chat history. Default to translator.open_ai.concurrency "
+                                 "in config.")
 
     def determine_translation_target(self):
         while True:
@@ -81,13 +86,30 @@ class OpenAILibTranslator(CachedTranslatorTemplate):
                 return False
             target_lang = self._target
             model = self._model
+        self._target = target_lang
+        self._model = model
         _separator = oconfig['batch_separator']
         _max_len = oconfig['batch_max_textlen']
         _batch_size = oconfig['batch_size']
-        self._open_ai = BatchTranslator(OpenAITranslator(model=model, target_lang=target_lang),
-                                        _separator, _max_len, _batch_size)
+        concurrency = self.args.concurrency
+        if concurrency is None:
+            concurrency = oconfig.get('concurrency', 1)
+        assert concurrency > 0, f'The --concurrency ({concurrency}) should be greater than 0!'
+        if concurrency > 1:
+            translator = AsyncOpenAITranslator(model=model, target_lang=target_lang, concurrency=concurrency)
+        else:
+            translator = OpenAITranslator(model=model, target_lang=target_lang)
+        token_counter = get_token_counter(oconfig.get('batch_tokenizer', 'char'), model)
+        self._open_ai = BatchTranslator(translator, _separator, _max_len, _batch_size, num_parallel=concurrency,
+                                        token_counter=token_counter)
         return True
 
+    def memory_namespace(self):
+        prompt = dict(self.config['translator']['open_ai']['chat']['completions'])
+        prompt.pop('model', None)
+        prompt.pop('stream', None)
+        return MemoryNamespace('openai', self._model, self._target, prompt)
+
     def translate(self, text: str):
         stripped_text = strip_or_none(text)
         if stripped_text is not None:
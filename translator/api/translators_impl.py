@@ -22,6 +22,7 @@ from prettytable import PrettyTable
 
 from command.translation.base import register_cmd_translator
 from config.base import ProjzConfig
+from trans.memory import MemoryNamespace
 from trans.translators_api import TranslatorsTranslator
 from translator.base import CachedTranslatorTemplate
 from util import my_input, line_to_args
@@ -112,6 +113,9 @@ class TranslatorsLibTranslator(CachedTranslatorTemplate):
                     except Exception as e:
                         logging.exception(e)
 
+    def memory_namespace(self):
+        return MemoryNamespace('translators', self.translator, self._target, self._source)
+
     def translate(self, text: str):
         return self._translator.translate(text)
 
@@ -15,11 +15,62 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import logging
 from argparse import ArgumentParser
-from typing import Tuple, List
+from typing import Tuple, List, Optional, Dict
 
 from config.base import ProjzConfig
-from store.database.base import flush
 from trans import Translator
+from trans.memory import MemoryNamespace, MemoryTranslator, get_translation_memory
+from trans.placeholder import PlaceholderTranslator, get_placeholder_translator
+from .writer import TranslationWriter
+
+
+class TextDeduplicator:
+    '''
+    Collapse identical texts into one translation request, whose tid is the first tid of these texts,
+    and fan out the translation to all tids of the text.
+    '''
+
+    def __init__(self, tids_and_text: List[Tuple[str, str]]):
+        tids_of_text: Dict[str, List[str]] = dict()
+        for tid, text in tids_and_text:
+            tids_of_text.setdefault(text, []).append(tid)
+        self.unique_tids_and_text = [(tids[0], text) for text, tids in tids_of_text.items()]
+        self._tids = {tids[0]: tids for tids in tids_of_text.values() if len(tids) > 1}
+        self.n_total = len(tids_and_text)
+        self.n_unique = len(self.unique_tids_and_text)
+
+    @property
+    def ratio(self):
+        return 1 - self.n_unique / self.n_total if self.n_total else 0.
+
+    def report(self):
+        if self.n_unique < self.n_total:
+            print(f'Deduplicated {self.n_total} texts into {self.n_unique} unique texts '
+                  f'(dedup ratio: {self.ratio:.1%})')
+
+    def fan_out(self, tids_and_text: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        res = []
+        for tid, text in tids_and_text:
+            for t in self._tids.get(tid, (tid,)):
+                res.append((t, text))
+        return res
+
+    def wrap(self, update_func):
+        '''
+        Wrap an update_func of invoke() to receive translations of all tids
+        '''
+
+        def _update(tids_and_text: List[Tuple[str, str]]):
+            return update_func(self.fan_out(tids_and_text))
+
+        return _update
+
+
+def translated_pairs(tids: List[str], new_texts: List[Optional[str]]) -> List[Tuple[str, str]]:
+    '''
+    Pair tids with their translations, lines rejected by the PlaceholderTranslator (None) are left untranslated.
+    '''
+    return [(tid, new_text) for tid, new_text in zip(tids, new_texts) if new_text is not None]
 
 
 class TranslatorTemplate(Translator):
@@ -40,14 +91,49 @@ class TranslatorTemplate(Translator):
     def close(self):
         pass
 
+    def memory_namespace(self) -> Optional[MemoryNamespace]:
+        '''
+        The namespace of translations of this translator in the translation memory.
+        :return: None if translations of this translator should not be memorized
+        '''
+        return None
+
+    def memorized(self) -> Translator:
+        '''
+        Return a translator that looks up the translation memory before calling translate_batch() of this translator,
+        with RenPy variables, tags and escape chars masked by placeholders if translator.placeholder is enabled
+        '''
+        # placeholders are checked before translations are saved to the memory
+        translator = get_placeholder_translator(self)
+        memory = get_translation_memory()
+        namespace = self.memory_namespace() if memory is not None else None
+        if namespace is None:
+            return translator
+        print(f'Using translation memory ({memory.db_file}) for {namespace}')
+        return MemoryTranslator(translator, namespace, memory)
+
+    @staticmethod
+    def print_stats(translator: Translator):
+        while translator is not None:
+            if isinstance(translator, MemoryTranslator):
+                print(f'Translation memory: {translator.memory.stats()}')
+            elif isinstance(translator, PlaceholderTranslator):
+                print(f'Placeholders: {translator.stats()}')
+            translator = getattr(translator, '_translator', None)
+
     def invoke(self, tids_and_text: List[Tuple[str, str]], update_func):
+        dedup = TextDeduplicator(tids_and_text)
+        dedup.report()
+        tids_and_text, update_func = dedup.unique_tids_and_text, dedup.wrap(update_func)
         texts = [t[1] for t in tids_and_text]
         tids = [t[0] for t in tids_and_text]
-        new_texts = self.translate_batch(texts)
+        translator = self.memorized()
+        new_texts = translator.translate_batch(texts)
         if len(new_texts) != len(texts):
             print(f'Returned translated texts are expected with size of {len(texts)}, but got {len(new_texts)}')
-        new_tid_and_text = list(zip(tids, new_texts))
+        new_tid_and_text = translated_pairs(tids, new_texts)
         update_func(new_tid_and_text)
+        self.print_stats(translator)
         self.close()  # close for the subclass
 
 
@@ -66,21 +152,29 @@ class CachedTranslatorTemplate(TranslatorTemplate):
         return True
 
     def invoke(self, tids_and_text: List[Tuple[str, str]], update_func):
+        dedup = TextDeduplicator(tids_and_text)
+        dedup.report()
+        tids_and_text, update_func = dedup.unique_tids_and_text, dedup.wrap(update_func)
         texts = [t[1] for t in tids_and_text]
         tids = [t[0] for t in tids_and_text]
         n_texts = len(tids_and_text)
-        for i in range(0, n_texts, self._cache_size):
-            end_dix = min(i + self._cache_size, n_texts)
-            # print(i, end_dix, n_texts)
-            batch_tids = tids[i:end_dix]
-            batch_texts = texts[i:end_dix]
-            new_texts = self.translate_batch(batch_texts)
-            if len(new_texts) != len(batch_texts):
-                print(
-                    f'Returned translated texts are expected with size of {len(batch_texts)}, but got {len(new_texts)}')
-                continue
-            new_tid_and_text = list(zip(batch_tids, new_texts))
-            update_func(new_tid_and_text)
-            print('Flushing...')
-            flush()
+        translator = self.memorized()
+        # translations are written by another thread, so translating the next batch is not blocked by disk I/O
+        writer = TranslationWriter.from_config(update_func, self.config, self._cache_size)
+        writer.start()
+        try:
+            for i in range(0, n_texts, self._cache_size):
+                end_dix = min(i + self._cache_size, n_texts)
+                # print(i, end_dix, n_texts)
+                batch_tids = tids[i:end_dix]
+                batch_texts = texts[i:end_dix]
+                new_texts = translator.translate_batch(batch_texts)
+                if len(new_texts) != len(batch_texts):
+                    print(
+                        f'Returned translated texts are expected with size of {len(batch_texts)}, but got {len(new_texts)}')
+                    continue
+                writer.put(translated_pairs(batch_tids, new_texts))
+        finally:
+            writer.close()
+        self.print_stats(translator)
         self.close()  # close for the subclass
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import logging
+import queue
 import threading
 import time
 from argparse import ArgumentParser
@@ -23,7 +24,8 @@ from typing import List, Tuple
 import tqdm
 
 from config.base import ProjzConfig
-from .template import TranslatorTemplate
+from .template import TranslatorTemplate, TextDeduplicator, translated_pairs
+from .writer import TranslationWriter
 from util import yes
 
 
@@ -73,16 +75,21 @@ class TranslationTaskRunner:
         self._wait_for_init = wait_for_init
         self._wait_prompt = wait_prompt
 
+    # The max number of times a batch is dispatched, a batch failing all of them is dropped
+    MAX_ATTEMPTS = 3
+
     def _inner_update(self, tids_and_text: List[Tuple[str, str]]):
-        try:
-            self._lock.acquire()
-            self._update_func(tids_and_text)
-        except Exception as e:
-            logging.exception(e)
-        finally:
-            self._lock.release()
+        # blocked if the writer falls behind
+        self._writer.put(tids_and_text)
+
+    def _requeue(self, batch: List[Tuple[str, str]], attempts: int):
+        if attempts < self.MAX_ATTEMPTS:
+            self._queue.put((batch, attempts))
+        else:
+            print(f'Dropping a batch of {len(batch)} texts failed for {attempts} times.')
+            self._n_dropped += len(batch)
 
-    def translation_task(self, counter: _translator_counter, tids_and_text: List[Tuple[str, str]]):
+    def translation_task(self, counter: _translator_counter):
         tid = threading.current_thread().ident
         translator = None
         try:
@@ -101,46 +108,83 @@ class TranslationTaskRunner:
         self._event.wait()
         if self._stop_flag:
             print(f'[{tid}] Stopped by user.')
+            translator.close()
             return
         try:
-            counter.invoke(tids_and_text, self._inner_update)
-        except Exception as e:
-            logging.exception(e)
+            self._pull_batches(tid, translator.memorized())
+        finally:
             translator.close()
 
+    def _pull_batches(self, tid, memorized):
+        # pull batches from the shared queue until all of them are done, including those requeued by others
+        while not self._stop_flag:
+            try:
+                batch, attempts = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._queue.unfinished_tasks == 0:
+                    break
+                continue
+            try:
+                try:
+                    new_texts = memorized.translate_batch([t[1] for t in batch])
+                except Exception as e:
+                    logging.exception(e)
+                    print(f'[{tid}] The web translator is failed, its batch is handed over to other translators.')
+                    self._requeue(batch, attempts + 1)
+                    break
+                if len(new_texts) != len(batch):
+                    print(f'Returned translated texts are expected with size of {len(batch)}, '
+                          f'but got {len(new_texts)}')
+                    self._requeue(batch, attempts + 1)
+                else:
+                    self._inner_update(translated_pairs([t[0] for t in batch], new_texts))
+            except Exception as e:
+                # translations can't be written, stop all translators
+                logging.exception(e)
+                print(f'[{tid}] Failed to write translations, stopping all translators.')
+                self._error = e
+                self._stop_flag = True
+                break
+            finally:
+                self._queue.task_done()
+
     def invoke(self, tids_and_text: List[Tuple[str, str]], update_func):
-        self._update_func = update_func
-        # Distribute untranslated texts to translators
+        dedup = TextDeduplicator(tids_and_text)
+        dedup.report()
+        tids_and_text = dedup.unique_tids_and_text
+        self._update_func = dedup.wrap(update_func)
+        # Distribute untranslated texts to translators by a queue of small batches
         n_texts = len(tids_and_text)
         if n_texts <= 0:
             return
-        batches = []
-        batch_size = (n_texts // self._args.num_workers) + 2
-        if batch_size == 1:
-            batches.append(tids_and_text)
-        else:
-            for i in range(0, n_texts, batch_size):
-                batches.append(tids_and_text[i: min(i + batch_size, n_texts)])
+        self._cache_size = max(self._config['translator']['write_cache_size'], 1)
+        batch_size = max(1, min(self._cache_size, n_texts // (self._num_workers * 4) + 1))
+        self._queue = queue.Queue()
+        for i in range(0, n_texts, batch_size):
+            self._queue.put((tids_and_text[i: min(i + batch_size, n_texts)], 0))
 
-        true_num_worker = len(batches)
-        print(f'Dispatching {true_num_worker} worker(s) with batch size = {batch_size}')
+        true_num_worker = min(self._num_workers, self._queue.qsize())
+        print(f'Dispatching {true_num_worker} worker(s) for {self._queue.qsize()} batches with batch size = {batch_size}')
 
         # do_init for translators
         threads = []
         counters = []
         self._event = threading.Event()
         self._event.clear()
-        self._lock = threading.Lock()
+        self._writer = TranslationWriter.from_config(self._update_func, self._config, self._cache_size)
+        self._writer.start()
+        self._n_dropped = 0
         self._sem = threading.BoundedSemaphore(true_num_worker)
         self._wait_flag = self._wait_for_init
         self._stop_flag = False
+        self._error = None
         executor = ThreadPoolExecutor(max_workers=self._num_workers)
-        for b in batches:
+        for _ in range(true_num_worker):
             if self._wait_for_init:
                 self._sem.acquire()
             counter = _translator_counter(self._count_on_batch)
             counters.append(counter)
-            threads.append(executor.submit(self.translation_task, counter, b))
+            threads.append(executor.submit(self.translation_task, counter))
 
         def _all_done(ts):
             for t in ts:
@@ -149,7 +193,7 @@ class TranslationTaskRunner:
             return True
 
         if self._wait_for_init:
-            for i in range(len(batches)):
+            for i in range(true_num_worker):
                 self._sem.acquire()
             print(self._wait_prompt)
 
@@ -164,12 +208,18 @@ class TranslationTaskRunner:
                 if cnt > last_cnt:
                     pbar.update(cnt - last_cnt)
                     last_cnt = cnt
+            n_left = sum(len(b) for b, _ in list(self._queue.queue))
+            if n_left > 0 or self._n_dropped > 0:
+                print(f'All translators are stopped, {n_left} texts are left and {self._n_dropped} texts are dropped.')
             print('Translation task is completed.')
         else:
             self._stop_flag = True
             self._event.set()
             print('Translation task is canceled.')
         executor.shutdown()
+        self._writer.close()
+        if self._error is not None:
+            raise self._error
 
 
 class ConcurrentTranslatorTemplate(TranslatorTemplate):
@@ -0,0 +1,128 @@
+# projz_renpy_translation, a translator for RenPy games
+# Copyright (C) 2023  github.com/abse4411
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import logging
+import queue
+import threading
+import time
+from typing import List, Tuple, Callable
+
+from config.base import ProjzConfig
+from store.database.base import flush
+
+_STOP = object()
+
+
+class TranslationWriter(threading.Thread):
+    """
+    A single writer thread which takes translated texts from translators by a bounded queue, coalesces them into
+    large update_func calls, and flushes the dbs once enough lines are updated or some time has passed.
+    Translators are blocked in put() when the queue is full, i.e., the writer falls behind.
+    If update_func fails, put() and close() raise the error, so the lost lines are not taken as written.
+    """
+
+    def __init__(self, update_func: Callable[[List[Tuple[str, str]]], None], cache_size: int,
+                 flush_interval: float = 30., queue_size: int = 8):
+        '''
+
+        :param update_func: The update_func of invoke()
+        :param cache_size: Flush the dbs once this number of lines are updated
+        :param flush_interval: Flush the dbs if updated lines are not flushed for this seconds
+        :param queue_size: The max number of results waiting for the writer
+        '''
+        super().__init__(daemon=True)
+        assert cache_size > 0, f'cache_size({cache_size}) should be greater than 0!'
+        self._update_func = update_func
+        self._cache_size = cache_size
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue(max(queue_size, 1))
+        self.n_written = 0
+        self.n_failed = 0
+        self.n_flushes = 0
+        self.error = None
+
+    @classmethod
+    def from_config(cls, update_func: Callable[[List[Tuple[str, str]]], None], config: ProjzConfig,
+                    cache_size: int):
+        tconfig = config['translator']
+        return cls(update_func, cache_size, tconfig.get('write_flush_interval', 30.),
+                   tconfig.get('write_queue_size', 8))
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError(f'Failed to write {self.n_failed} translated lines: {self.error}') from self.error
+
+    def put(self, tids_and_text: List[Tuple[str, str]]):
+        # stop translating if translations can't be written
+        self._raise_error()
+        if tids_and_text:
+            self._queue.put(tids_and_text)
+
+    def _write(self, pending: List[Tuple[str, str]]):
+        try:
+            self._update_func(pending)
+            self.n_written += len(pending)
+        except Exception as e:
+            logging.exception(e)
+            self.n_failed += len(pending)
+            if self.error is None:
+                self.error = e
+
+    def _flush(self):
+        print('Flushing...')
+        try:
+            flush()
+            self.n_flushes += 1
+        except Exception as e:
+            logging.exception(e)
+
+    def run(self):
+        unflushed = 0
+        last_flush = time.monotonic()
+        stopped = False
+        while not stopped:
+            pending = []
+            try:
+                timeout = max(0.1, self._flush_interval - (time.monotonic() - last_flush)) if unflushed else None
+                item = self._queue.get(timeout=timeout)
+                # coalesce results which are already waiting
+                while True:
+                    if item is _STOP:
+                        stopped = True
+                        break
+                    pending.extend(item)
+                    if len(pending) >= self._cache_size:
+                        break
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            if pending:
+                self._write(pending)
+                unflushed += len(pending)
+            if unflushed > 0 and (stopped or unflushed >= self._cache_size or
+                                  time.monotonic() - last_flush >= self._flush_interval):
+                self._flush()
+                unflushed = 0
+                last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Wait for all results to be written and flushed.
+        """
+        self._queue.put(_STOP)
+        self.join()
+        if self.n_failed > 0:
+            print(f'{self.n_failed} translated lines are not written!')
+        self._raise_error()
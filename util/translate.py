@@ -1,4 +1,6 @@
-from typing import List
+import logging
+from collections import Counter
+from typing import List, Callable, Optional
 
 import tqdm
 
@@ -6,9 +8,46 @@ from config.base import ProjzConfig
 from trans import Translator
 
 
+def get_token_counter(name: str = 'char', model: str = None) -> Callable[[str], int]:
+    '''
+    Return a function estimating the number of tokens of a text.
+    :param name: 'char' counts characters, 'tiktoken' counts tokens of the model by tiktoken (if installed)
+    :param model: The model name for tiktoken
+    :return:
+    '''
+    if name == 'tiktoken':
+        try:
+            import tiktoken
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding('cl100k_base')
+            return lambda text: len(encoding.encode(text, disallowed_special=()))
+        except ImportError:
+            print('tiktoken is not installed, counting characters of texts instead. '
+                  'You can install it by: pip install tiktoken')
+        except Exception as e:
+            logging.exception(e)
+    else:
+        assert name == 'char', f'Unknown tokenizer: {name}'
+    return len
+
+
 class BatchTranslator(Translator):
-    def __init__(self, translator: Translator, batch_separator:str, batch_max_textlen:int, batch_size:int, show_bar: bool = True):
+    def __init__(self, translator: Translator, batch_separator:str, batch_max_textlen:int, batch_size:int, show_bar: bool = True,
+                 num_parallel: int = 1, token_counter: Callable[[str], int] = None):
+        '''
+
+        :param batch_max_textlen: The token budget of a batch, counted by token_counter
+        :param batch_size: The max number of texts in a batch
+        :param num_parallel: The number of batches passed to translator.translate_batch at once,
+                             which can be translated concurrently by the translator.
+        :param token_counter: A function returning the number of tokens of a text, default to counting characters.
+        '''
+        self._count = token_counter if token_counter is not None else len
         self._translator = translator
+        self.num_parallel = num_parallel
+        assert self.num_parallel > 0, f'num_parallel: {self.num_parallel} should >0!'
         self._show_bar = show_bar
         self._separator = batch_separator
         self._max_len = batch_max_textlen
@@ -16,11 +55,17 @@ class BatchTranslator(Translator):
         assert self.batch_size > 0, f'batch_size: {self.batch_size} should >0!'
         self._separator = self._separator.strip()
         assert self._separator != '', f'separator should not be empty!'
+        self._joiner = f'\n\n {self._separator} \n\n'
+        # how often each strategy is used, for tuning the batch_size
+        self.strategy_stats = Counter(joined=0, bisect=0, per_line=0)
         print(f'Using BatchTranslator with batch_size: {self.batch_size}, separator: {self._separator}, max text len: {self._max_len}')
 
     def translate(self, text: str) -> str:
         return self._translator.translate(text)
 
+    def close(self):
+        self._translator.close()
+
     class _tqdm_proxy:
         def __init__(self, total: int = None, desc: str = None):
             if total is not None:
@@ -41,25 +86,93 @@ class BatchTranslator(Translator):
             if self._bar is not None:
                 self._bar.close()
 
-    def translate_batch(self, texts: List[str]) -> List[str]:
-        new_texts = []
-        with BatchTranslator._tqdm_proxy(total=len(texts) if self._show_bar else None, desc='Translating...') as bar:
-            for i in range(0, len(texts), self.batch_size):
-                batch_text = texts[i:min(len(texts), i + self.batch_size)]
-                final_text = f'\n\n {self._separator} \n\n'.join(batch_text)
-                # if reaching the limit of max text len
-                if len(final_text) > self._max_len:
-                    new_texts.extend(self._translator.translate_batch(batch_text))
-                    bar.update(len(batch_text))
-                    continue
-                res = self.translate(final_text)
-                new_batch_text = res.split(self._separator)
-                # if we cannot split it with its size equaling original one
+    def pack(self, texts: List[str]) -> List[List[int]]:
+        '''
+        Pack texts into batches which fill up the token budget (batch_max_textlen) as much as possible.
+        Texts are taken from the longest ones, and each batch is topped up with the shortest ones.
+        :return: Batches of indexes of texts, a text exceeding the budget is left in a batch alone.
+        '''
+        costs = [self._count(t) for t in texts]
+        sep_cost = self._count(self._joiner)
+        order = sorted(range(len(texts)), key=lambda k: costs[k], reverse=True)
+        batches = []
+        lo, hi = 0, len(order) - 1
+        while lo <= hi:
+            batch = [order[lo]]
+            used = costs[order[lo]]
+            lo += 1
+            while len(batch) < self.batch_size and lo <= hi:
+                if used + sep_cost + costs[order[lo]] <= self._max_len:
+                    k = order[lo]
+                    lo += 1
+                elif used + sep_cost + costs[order[hi]] <= self._max_len:
+                    k = order[hi]
+                    hi -= 1
+                else:
+                    break
+                batch.append(k)
+                used += sep_cost + costs[k]
+            # keep the original order of texts in a batch
+            batches.append(sorted(batch))
+        batches.sort(key=lambda b: b[0])
+        return batches
+
+    def _translate_joined(self, group: List[List[str]]) -> List[Optional[List[str]]]:
+        '''
+        Translate each batch of the group as a joined text.
+        :return: Translations of each batch, or None if the translation of a batch cannot be split into its size
+        '''
+        final_texts = [self._joiner.join(batch_text) for batch_text in group]
+        # a text exceeding the budget is not joined
+        joined = [k for k, t in enumerate(final_texts) if self._count(t) <= self._max_len]
+        results = dict()
+        if joined:
+            results = dict(zip(joined, self._translator.translate_batch([final_texts[k] for k in joined])))
+        new_group = []
+        for k, batch_text in enumerate(group):
+            res = results.get(k, None)
+            new_batch_text = None
+            if res is not None:
+                new_batch_text = [t.strip() for t in res.split(self._separator)]
                 if len(new_batch_text) != len(batch_text):
-                    new_texts.extend(self._translator.translate_batch(batch_text))
+                    # a single text is sent as it is, so its translation is always accepted
+                    new_batch_text = [res] if len(batch_text) == 1 else None
+            new_group.append(new_batch_text)
+        return new_group
+
+    def _recover(self, batch_text: List[str]) -> List[str]:
+        '''
+        Translate a failed batch by splitting it in halves recursively, only the minimal failing texts are
+        translated line by line.
+        '''
+        if len(batch_text) <= 1:
+            self.strategy_stats['per_line'] += len(batch_text)
+            return self._translator.translate_batch(batch_text)
+        self.strategy_stats['bisect'] += 1
+        mid = len(batch_text) // 2
+        halves = [batch_text[:mid], batch_text[mid:]]
+        new_batch_text = []
+        for half, res in zip(halves, self._translate_joined(halves)):
+            new_batch_text.extend(res if res is not None else self._recover(half))
+        return new_batch_text
+
+    def translate_batch(self, texts: List[str]) -> List[Optional[str]]:
+        new_texts = [None] * len(texts)
+        with BatchTranslator._tqdm_proxy(total=len(texts) if self._show_bar else None, desc='Translating...') as bar:
+            batches = self.pack(texts)
+            for j in range(0, len(batches), self.num_parallel):
+                group = [[texts[k] for k in b] for b in batches[j:j + self.num_parallel]]
+                for k, (batch_text, new_batch_text) in enumerate(zip(group, self._translate_joined(group))):
+                    if new_batch_text is None:
+                        # if we cannot split it with its size equaling original one
+                        new_batch_text = self._recover(batch_text)
+                    else:
+                        self.strategy_stats['joined'] += 1
+                    for idx, t in zip(batches[j + k], new_batch_text):
+                        new_texts[idx] = t
                     bar.update(len(batch_text))
-                    continue
-                new_batch_text = [j.strip() for j in new_batch_text]
-                new_texts.extend(new_batch_text)
-                bar.update(len(batch_text))
+            if self.strategy_stats['bisect'] > 0 or self.strategy_stats['per_line'] > 0:
+                print(f'Batch strategies: {dict(self.strategy_stats)} (joined: batches translated at once, '
+                      f'bisect: failed batches split in halves, per_line: texts translated alone)')
+            # None for texts missing in a wrong-sized result or failed in the translator, they are left untranslated
             return new_texts